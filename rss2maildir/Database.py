@@ -20,8 +20,16 @@
 
 import os
 import dbm
+import glob
+import time
+import struct
+import hashlib
 import logging
 import marshal
+import sqlite3
+import binascii
+import threading
+import email.utils
 
 from .utils import mkdir_p
 
@@ -30,65 +38,574 @@ log = logging.getLogger('database')
 serialize = marshal.dumps
 deserialize = marshal.loads
 
+def make_key(feed_url, key):
+    return (feed_url + u'|' + key).encode('utf-8')
+
+def split_key(key, feed_urls):
+    # dbm keys are feed url and guid or link joined by '|', both of which
+    # may contain a '|' themselves, so prefer a split at a known feed url
+    key = key.decode('utf-8')
+    position = key.find(u'|')
+    while position != -1:
+        if key[:position] in feed_urls:
+            break
+        position = key.find(u'|', position + 1)
+    else:
+        position = key.find(u'|')
+
+    return key[:position], key[position + 1:]
+
+class SeenRecord(object):
+    '''
+    SeenRecord describes a delivered item: the md5 digest of its content,
+    its creation time and the message id it was delivered with.
+
+    Records are stored in a fixed binary layout, a version byte, the raw
+    digest, the creation time in seconds since the epoch and the length
+    prefixed message id. The fields are only decoded when accessed.
+    Records written by older versions as marshalled dicts are read
+    transparently.
+    '''
+
+    layout = struct.Struct('>B16sqI')
+    version = 1
+
+    def __init__(self, digest = None, created = None, message_id = None):
+        self.data = None
+        self._digest = digest
+        self._created = created
+        self._message_id = message_id
+
+    @classmethod
+    def unpack(cls, data):
+        if data[:1] == chr(cls.version):
+            record = cls()
+            record.data = data
+            return record
+
+        # a record from before the binary layout
+        data = deserialize(data)
+        return cls(binascii.unhexlify(data['contentmd5']),
+                   data['created'],
+                   data.get('message-id'))
+
+    def pack(self):
+        if self.data is not None:
+            return self.data
+
+        message_id = (self.message_id or '').encode('utf-8')
+        return self.layout.pack(self.version, self.digest, self.created,
+                                len(message_id)) + message_id
+
+    @property
+    def digest(self):
+        if self._digest is None and self.data is not None:
+            self._digest = self.data[1:17]
+        elif self._digest is not None and len(self._digest) == 32:
+            self._digest = binascii.unhexlify(self._digest)
+        return self._digest
+
+    @property
+    def created(self):
+        if self._created is None and self.data is not None:
+            self._created = self.layout.unpack_from(self.data)[2]
+        elif isinstance(self._created, basestring):
+            self._created = parse_created(self._created)
+        return self._created
+
+    @property
+    def message_id(self):
+        if self._message_id is None and self.data is not None:
+            length = self.layout.unpack_from(self.data)[3]
+            if length:
+                start = self.layout.size
+                self._message_id = self.data[start:start + length].decode('utf-8')
+        return self._message_id
+
+def parse_created(value):
+    # older records keep the date as formatted for the Date header
+    if value.isdigit():
+        return int(value)
+    parsed = email.utils.parsedate_tz(value)
+    if parsed:
+        return email.utils.mktime_tz(parsed)
+    return 0
+
+class SeenIndex(object):
+    '''
+    SeenIndex maps the guids and links of one feed to the md5 digest of
+    the content last seen for them. The entries are kept packed and
+    sorted by a hash of the key, behind a Bloom filter so that lookups
+    for new items usually end without searching the entries.
+    '''
+
+    header = struct.Struct('>BI')
+    entry = struct.Struct('>8s16s')
+    version = 1
+    hashes = 4
+
+    def __init__(self, data = None):
+        self.changes = {}
+        self.changed = False
+        self.bloom = ''
+        self.entries = ''
+
+        if data:
+            version, bloom_size = self.header.unpack_from(data)
+            if version != self.version:
+                raise ValueError('Unknown index version %i' % version)
+            start = self.header.size
+            self.bloom = data[start:start + bloom_size]
+            self.entries = data[start + bloom_size:]
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        index = cls()
+        for key, digest in pairs:
+            index.set(key, digest)
+        return cls(index.pack())
+
+    def __len__(self):
+        return len(self.entries) // self.entry.size
+
+    def keyhash(self, key):
+        return hashlib.md5(key.encode('utf-8')).digest()[:8]
+
+    def bloom_positions(self, keyhash, bits):
+        first, second = struct.unpack('>II', keyhash)
+        return [(first + n * second) % bits for n in range(self.hashes)]
+
+    def maybe_contains(self, keyhash):
+        bits = len(self.bloom) * 8
+        if not bits:
+            return False
+        return all(ord(self.bloom[position >> 3]) & (1 << (position & 7))
+                   for position in self.bloom_positions(keyhash, bits))
+
+    def search(self, keyhash):
+        size = self.entry.size
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            candidate = self.entries[middle * size:middle * size + 8]
+            if candidate < keyhash:
+                low = middle + 1
+            elif candidate > keyhash:
+                high = middle
+            else:
+                return self.entries[middle * size + 8:(middle + 1) * size]
+        return None
+
+    def get(self, key):
+        keyhash = self.keyhash(key)
+        if keyhash in self.changes:
+            return self.changes[keyhash]
+
+        if not self.maybe_contains(keyhash):
+            return None
+        return self.search(keyhash)
+
+    def set(self, key, digest):
+        self.changes[self.keyhash(key)] = digest
+        self.changed = True
+
+    def discard(self, key):
+        self.set(key, None)
+
+    def pack(self):
+        entries = dict(self.entry.unpack_from(self.entries, offset)
+                       for offset in range(0, len(self.entries), self.entry.size))
+        entries.update(self.changes)
+        entries = sorted((keyhash, digest) for keyhash, digest in entries.items()
+                         if digest is not None)
+
+        # ten bits per key keep the false positive rate around one percent
+        bloom = bytearray((max(64, len(entries) * 10) + 7) // 8)
+        for keyhash, digest in entries:
+            for position in self.bloom_positions(keyhash, len(bloom) * 8):
+                bloom[position >> 3] |= 1 << (position & 7)
+
+        return self.header.pack(self.version, len(bloom)) + str(bloom) + \
+            ''.join(self.entry.pack(keyhash, digest) for keyhash, digest in entries)
+
 class Database(object):
+    '''
+    Database keeps track of the items that have been delivered and of
+    per feed metadata. Subclasses implement the storage.
+
+    Lookups go through a SeenIndex per feed that is loaded once, changes
+    are buffered and written back in one batch by commit().
+    '''
+
     def __init__(self, path):
         try:
             mkdir_p(path)
         except OSError as e:
-            raise RuntimeError("Couldn't create statedir %s: %s" % (settings['state_dir'], str(e)))
+            raise RuntimeError("Couldn't create statedir %s: %s" % (path, str(e)))
 
-        self.feeds = dbm.open(os.path.join(path, "feeds"), "c")
-        self.seen = dbm.open(os.path.join(path, "seen"), "c")
+        self.path = path
+        self.indexes = {}
+        self.pending = {}
 
-    def __del__(self):
-        self.feeds.close()
-        self.seen.close()
+        # feeds are fetched from worker threads, serialize access to
+        # the storage
+        self.lock = threading.RLock()
+
+    def index(self, feed_url):
+        with self.lock:
+            if feed_url not in self.indexes:
+                self.indexes[feed_url] = self.load_index(feed_url)
+            return self.indexes[feed_url]
+
+    def get_seen(self, feed_url, key):
+        with self.lock:
+            if (feed_url, key) in self.pending:
+                return self.pending[(feed_url, key)]
+            return self.load_seen(feed_url, key)
+
+    def set_seen(self, feed_url, key, record):
+        with self.lock:
+            self.pending[(feed_url, key)] = record
+            self.index(feed_url).set(key, record.digest)
 
     def seen_before(self, item):
-        if item.db_guid_key:
-            if self.seen.has_key(item.db_guid_key):
-                data = deserialize(self.seen[item.db_guid_key])
-                if data['contentmd5'] == item.md5sum:
-                    return True
+        index = self.index(item.feed.url)
+        digest = binascii.unhexlify(item.md5sum)
 
-        if self.seen.has_key(item.db_link_key):
-            data = deserialize(self.seen[item.db_link_key])
+        if item.guid and index.get(item.guid) == digest:
+            return True
 
-            if data.has_key('message-id'):
-                item.previous_message_id = data['message-id']
+        link_digest = index.get(item.link)
+        if link_digest is None:
+            return False
 
-            if data['contentmd5'] == item.md5sum:
-                return True
+        # the message id is only needed to thread updates, only read the
+        # full record for those
+        if link_digest != digest:
+            record = self.get_seen(item.feed.url, item.link)
+            if record and record.message_id:
+                item.previous_message_id = record.message_id
+            return False
 
-        return False
+        return True
+
+    def known(self, item):
+        # whether the item has been marked as seen, whatever its content
+        # was at the time
+        index = self.index(item.feed.url)
+        if item.guid and index.get(item.guid) is not None:
+            return True
+        return index.get(item.link) is not None
 
     def mark_seen(self, item):
         if item.previous_message_id:
             item.message_id = item.previous_message_id + " " + item.message_id
 
-        data = serialize({
-            'message-id': item.message_id,
-            'created': item.createddate,
-            'contentmd5': item.md5sum
-        })
+        record = SeenRecord(binascii.unhexlify(item.md5sum), item.created,
+                            item.message_id)
 
         if item.guid and item.guid != item.link:
-            self.seen[item.db_guid_key] = data
-            try:
-                previous_data = deserialize(self.seen[item.db_link_key])
-                newdata = serialize({
-                    'message-id': item.message_id,
-                    'created': previous_data['created'],
-                    'contentmd5': previous_data['contentmd5']
-                })
-                self.seen[item.db_link_key] = newdata
-            except:
-                self.seen[item.db_link_key] = data
-        else:
-            self.seen[item.db_link_key] = data
+            self.set_seen(item.feed.url, item.guid, record)
+            previous_record = self.get_seen(item.feed.url, item.link)
+            if previous_record:
+                record = SeenRecord(previous_record.digest,
+                                    previous_record.created,
+                                    item.message_id)
+
+        self.set_seen(item.feed.url, item.link, record)
+
+    def commit(self):
+        with self.lock:
+            if self.pending:
+                self.store_seen(self.pending)
+                self.pending = {}
+
+            for feed_url, index in self.indexes.items():
+                if index.changed:
+                    self.store_index(feed_url, index)
+            self.indexes = {}
+
+            self.flush()
+
+    def prune(self, max_age):
+        '''
+        Drop the records of items older than max_age seconds that are
+        no longer part of their feed. Returns the number of records
+        removed.
+
+        Feeds that have not been parsed since they started to remember
+        what they contain are left alone, their items may well still be
+        there and would be delivered again.
+        '''
+
+        self.commit()
+
+        # the items a feed contained the last time it was parsed
+        known = set()
+        current = set()
+        for url in self.feed_urls():
+            metadata = self.get_feed_metadata(url)
+            if 'current' in metadata:
+                known.add(url)
+                for key in metadata['current']:
+                    current.add((url, key))
+
+        cutoff = time.time() - max_age
+        expired = []
+        for (feed_url, key), record in self.iter_seen():
+            if feed_url not in known or (feed_url, key) in current:
+                continue
+
+            if record.created and record.created < cutoff:
+                expired.append((feed_url, key))
+
+        for feed_url, key in expired:
+            self.delete_seen(feed_url, key)
+            self.index(feed_url).discard(key)
+        self.commit()
+
+        return len(expired)
+
+    def size(self):
+        return sum(os.path.getsize(filename) for filename in self.files())
+
+    def store_index(self, feed_url, index):
+        pass
+
+    def compact(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class DbmDatabase(Database):
+    '''
+    DbmDatabase stores the state in dbm files: feeds, seen and the
+    packed per feed index.
+    '''
+
+    def __init__(self, path):
+        Database.__init__(self, path)
+        new_index = not glob.glob(os.path.join(path, 'index*'))
+
+        self.feeds = dbm.open(os.path.join(path, "feeds"), "c")
+        self.seen = dbm.open(os.path.join(path, "seen"), "c")
+        self.index_db = dbm.open(os.path.join(path, "index"), "c")
+
+        if new_index and len(self.seen.keys()):
+            self.build_indexes()
+
+    def build_indexes(self):
+        # state directories from before the index existed need one pass
+        # over all records
+        log.info('Building the seen index')
+        pairs = {}
+        for (feed_url, key), record in self.iter_seen():
+            pairs.setdefault(feed_url, []).append((key, record.digest))
+
+        for feed_url, feed_pairs in pairs.items():
+            self.store_index(feed_url, SeenIndex.from_pairs(feed_pairs))
+
+    def close(self):
+        self.commit()
+        self.feeds.close()
+        self.seen.close()
+        self.index_db.close()
+
+    def files(self):
+        return [filename
+                for name in ('feeds', 'seen', 'index')
+                for filename in glob.glob(os.path.join(self.path, name + '*'))]
+
+    def compact(self):
+        # only gdbm is able to give space back
+        with self.lock:
+            for db in (self.feeds, self.seen, self.index_db):
+                if hasattr(db, 'reorganize'):
+                    db.reorganize()
+
+    def load_index(self, feed_url):
+        key = feed_url.encode('utf-8')
+        if self.index_db.has_key(key):
+            return SeenIndex(self.index_db[key])
+        return SeenIndex()
+
+    def store_index(self, feed_url, index):
+        self.index_db[feed_url.encode('utf-8')] = index.pack()
+
+    def iter_seen(self, feed_urls = ()):
+        feed_urls = set(feed_urls)
+        feed_urls.update(url.decode('utf-8') for url in self.feeds.keys())
+        for key in self.seen.keys():
+            yield split_key(key, feed_urls), SeenRecord.unpack(self.seen[key])
+
+    def load_seen(self, feed_url, key):
+        key = make_key(feed_url, key)
+        if self.seen.has_key(key):
+            return SeenRecord.unpack(self.seen[key])
+        return None
+
+    def store_seen(self, records):
+        for (feed_url, key), record in records.items():
+            self.seen[make_key(feed_url, key)] = record.pack()
+
+    def delete_seen(self, feed_url, key):
+        with self.lock:
+            del self.seen[make_key(feed_url, key)]
+
+    def feed_urls(self):
+        return self.feeds.keys()
+
+    def get_feed_metadata(self, url):
+        with self.lock:
+            return deserialize(self.feeds[url])
+
+    def set_feed_metadata(self, url, data):
+        with self.lock:
+            self.feeds[url] = serialize(data)
+
+class SQLiteDatabase(Database):
+    '''
+    SQLiteDatabase stores the state in a single SQLite database in WAL
+    mode. All changes made while processing a feed are committed in one
+    transaction.
+    '''
+
+    filename = 'state.sqlite'
+
+    schema = (
+        '''CREATE TABLE IF NOT EXISTS feeds (
+               url TEXT PRIMARY KEY,
+               data BLOB NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS seen (
+               feed_url TEXT NOT NULL,
+               key TEXT NOT NULL,
+               message_id TEXT,
+               created INTEGER,
+               contentmd5 BLOB,
+               PRIMARY KEY (feed_url, key))''',
+    )
+
+    def __init__(self, path):
+        Database.__init__(self, path)
+        # runs with locking = feed write to the database at the same
+        # time, wait for each other instead of failing right away
+        self.db = sqlite3.connect(os.path.join(path, self.filename),
+                                  timeout = 60, check_same_thread = False)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        for statement in self.schema:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def flush(self):
+        self.db.commit()
+
+    def files(self):
+        return glob.glob(os.path.join(self.path, self.filename + '*'))
+
+    def compact(self):
+        with self.lock:
+            self.commit()
+            self.db.execute('VACUUM')
+            self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def load_index(self, feed_url):
+        # the primary key doubles as the index, one range scan loads it
+        return SeenIndex.from_pairs(
+            (row[0], SeenRecord(str(row[1])).digest) for row in self.db.execute(
+                'SELECT key, contentmd5 FROM seen WHERE feed_url = ?', (feed_url, )))
+
+    def iter_seen(self):
+        with self.lock:
+            for row in self.db.execute(
+                    'SELECT feed_url, key, message_id, created, contentmd5 FROM seen'):
+                yield (row[0], row[1]), SeenRecord(str(row[4]), row[3], row[2])
+
+    def load_seen(self, feed_url, key):
+        row = self.db.execute(
+            'SELECT message_id, created, contentmd5 FROM seen '
+            'WHERE feed_url = ? AND key = ?', (feed_url, key)).fetchone()
+
+        if row is None:
+            return None
+        return SeenRecord(str(row[2]), row[1], row[0])
+
+    def store_seen(self, records):
+        self.db.executemany(
+            'INSERT OR REPLACE INTO seen '
+            '(feed_url, key, message_id, created, contentmd5) '
+            'VALUES (?, ?, ?, ?, ?)',
+            ((feed_url, key, record.message_id, record.created,
+              sqlite3.Binary(record.digest))
+             for (feed_url, key), record in records.items()))
+
+    def delete_seen(self, feed_url, key):
+        with self.lock:
+            self.db.execute('DELETE FROM seen WHERE feed_url = ? AND key = ?',
+                            (feed_url, key))
+
+    def feed_urls(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT url FROM feeds')]
 
     def get_feed_metadata(self, url):
-        return deserialize(self.feeds[url])
+        with self.lock:
+            row = self.db.execute('SELECT data FROM feeds WHERE url = ?',
+                                  (url, )).fetchone()
+        if row is None:
+            raise KeyError(url)
+        return deserialize(str(row[0]))
 
     def set_feed_metadata(self, url, data):
-        self.feeds[url] = serialize(data)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO feeds (url, data) VALUES (?, ?)',
+                            (url, sqlite3.Binary(serialize(data))))
+
+backends = {
+    'dbm': DbmDatabase,
+    'sqlite': SQLiteDatabase,
+}
+
+def open_database(path, backend = 'dbm'):
+    if backend not in backends:
+        raise RuntimeError('Unknown state backend %s, expected one of %s' %
+                           (backend, ', '.join(sorted(backends))))
+    return backends[backend](path)
+
+def migrate_dbm_to_sqlite(path, feed_urls = ()):
+    '''
+    Copy the state kept in the dbm files in path to a SQLite database
+    next to them. The dbm files are left untouched.
+    '''
+
+    source = DbmDatabase(path)
+    target = SQLiteDatabase(path)
+
+    for url in source.feed_urls():
+        target.set_feed_metadata(url, source.get_feed_metadata(url))
+
+    count = 0
+    records = {}
+    for (feed_url, key), record in source.iter_seen(feed_urls):
+        records[(feed_url, key)] = record
+        count += 1
+        if len(records) >= 10000:
+            target.store_seen(records)
+            records = {}
+    target.store_seen(records)
+
+    target.commit()
+    log.info('Migrated %i feeds and %i seen records to %s' %
+             (len(source.feed_urls()), count, target.filename))
+
+    source.close()
+    target.close()
+    return count
@@ -18,59 +18,369 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import zlib
+import time
+import socket
+import httplib
 import logging
+import tempfile
 import feedparser
+import email.utils
 
 from .Item import Item
-from .utils import open_url, generate_random_string
+from .Stats import stats
+from .StreamingParser import StreamingParser, ParseError
+from .utils import open_url, generate_random_string, FetchError, DeadlineReached
 
 log = logging.getLogger('rss2maildir:Feed')
 
 class Feed(object):
-    def __init__(self, database, url):
+    def __init__(self, database, url, streaming = False, early_stop = 0,
+                 max_body_size = 0, deadline = None,
+                 min_retry_interval = 900, max_retry_interval = 604800,
+                 rules = None, not_older_than = 0, max_items = 0):
         self.database = database
         self.url = url
+        self.streaming = streaming
+        self.early_stop = early_stop
+        self.max_body_size = max_body_size
+        self.deadline = deadline
+        self.min_retry_interval = min_retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.rules = rules
+        self.not_older_than = not_older_than
+        self.max_items = max_items
         self.name = url
+        self.fetched = False
+        self.deferred = False
+        self.error = None
+        self.polled = time.time()
+        self.headers = []
+        self.body = None
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+        self.parsed = False
+        self.stopped_early = False
+        self.ttl = None
+        self.current = set()
+        self.rejected = []
+        self.new = 0
+        self.capped = False
 
-    def is_changed(self):
+    def metadata(self):
         try:
-            previous_data = self.database.get_feed_metadata(self.url)
+            return self.database.get_feed_metadata(self.url)
         except KeyError as e:
-            return True
+            return {}
 
-        response = open_url('HEAD', self.url)
-        if not response:
-            log.warning('Fetching feed %s failed' % self.name)
-            return True
+    def conditional_headers(self):
+        previous_data = self.metadata()
 
-        result = False
-        for key, value in response.getheaders():
-            if previous_data.get(key, None) != value:
-                result = True
-                break
+        headers = {}
+        if 'etag' in previous_data:
+            headers['If-None-Match'] = previous_data['etag']
+        if 'last-modified' in previous_data:
+            headers['If-Modified-Since'] = previous_data['last-modified']
+        return headers
 
-        return result
+    def past_deadline(self):
+        return self.deadline is not None and time.time() > self.deadline
 
-    relevant_headers = ('content-md5', 'etag', 'last-modified', 'content-length')
-    def new_items(self):
-        if not self.is_changed():
+    spool_size = 1024 * 1024
+    def fetch(self):
+        # this only touches the network and the feed metadata, so it is
+        # safe to run it from a worker thread while other feeds are
+        # being parsed and delivered
+        self.fetched = True
+        self.polled = time.time()
+
+        # feeds that are deferred are left alone, so they are due again
+        # on the next run
+        if self.past_deadline():
+            self.deferred = True
+            return False
+
+        try:
+            response = open_url('GET', self.url, headers = self.conditional_headers(),
+                                deadline = self.deadline)
+        except DeadlineReached:
+            return self.defer()
+        except FetchError as e:
+            # Retry-After of a 429 or 503 response is honoured as well
+            self.headers = e.headers
+            return self.failed(str(e))
+
+        self.headers = response.getheaders()
+        if response.status == 304:
             log.info('Feed %s not changed, skipping' % self.url)
-            return
+            self.record_response(response)
+            stats.count(self.url, 'not_modified')
+            return False
+
+        # large feeds end up on disk instead of in memory
+        body = tempfile.SpooledTemporaryFile(self.spool_size)
+        try:
+            while True:
+                chunk = response.read(response.chunk_size)
+                if not chunk:
+                    break
+                body.write(chunk)
+
+                if self.max_body_size and response.bytes_decoded > self.max_body_size:
+                    body.close()
+                    return self.failed('feed is larger than %i bytes' % self.max_body_size)
+                if self.past_deadline():
+                    body.close()
+                    return self.defer()
+        except DeadlineReached:
+            body.close()
+            return self.defer()
+        except (httplib.HTTPException, socket.error, zlib.error) as e:
+            body.close()
+            return self.failed('reading the response failed: %s' % str(e))
+        finally:
+            response.close()
+            self.record_response(response)
+
+        body.seek(0)
+        self.body = body
+
+        self.bytes_received = response.bytes_received
+        self.bytes_decoded = response.bytes_decoded
+        log.info('Fetched feed %s: %i bytes transferred, %i bytes decoded' %
+                 (self.url, self.bytes_received, self.bytes_decoded))
+        return True
+
+    def defer(self):
+        log.warning('Run deadline reached while fetching feed %s' % self.url)
+        self.deferred = True
+        return False
+
+    def failed(self, error):
+        log.warning('Fetching feed %s failed: %s' % (self.url, error))
+        stats.count(self.url, 'fetch_failed')
+        self.error = error
+        return False
+
+    def record_response(self, response):
+        for name, seconds in response.timings.items():
+            stats.add_time(self.url, name, seconds)
+        stats.count(self.url, 'bytes_received', response.bytes_received)
+        stats.count(self.url, 'bytes_decoded', response.bytes_decoded)
+
+    def poll_hint(self, ttl = None):
+        # the longest the server or the feed itself asked us to wait
+        # before polling again, in seconds
+        hints = [0]
+        headers = dict(self.headers)
+
+        for directive in headers.get('cache-control', '').split(','):
+            name, _, value = directive.strip().partition('=')
+            if name.lower() == 'max-age' and value.isdigit():
+                hints.append(int(value))
+
+        retry_after = headers.get('retry-after', '').strip()
+        if retry_after.isdigit():
+            hints.append(int(retry_after))
+        elif retry_after:
+            parsed = email.utils.parsedate_tz(retry_after)
+            if parsed:
+                hints.append(int(email.utils.mktime_tz(parsed) - time.time()))
+
+        if ttl and str(ttl).strip().isdigit():
+            hints.append(int(ttl) * 60)
+
+        return max(hints)
+
+    def feed_items(self):
+        '''
+        Yield the entries of the feed. With streaming they come from
+        StreamingParser while the document is being read, if it turns
+        out to be malformed feedparser takes over and only yields the
+        entries that have not been yielded already.
+        '''
+
+        yielded = set()
+        if self.streaming:
+            # feedparser is not told the url of the feed either, so
+            # relative links are only resolved against xml:base
+            parser = StreamingParser(self.body)
+            try:
+                for feed_item in parser.items():
+                    # the ttl comes before the items, and new_items may
+                    # stop before the end of the document
+                    self.ttl = parser.feed.get('ttl')
+                    yielded.add((feed_item.get('guid'), feed_item.get('link')))
+                    yield feed_item
+                self.ttl = parser.feed.get('ttl')
+                return
+            except ParseError as e:
+                log.info('Streaming parser failed on feed %s, using feedparser: %s' %
+                         (self.url, str(e)))
+            self.body.seek(0)
+
+        parsed_feed = feedparser.parse(self.body)
+        self.ttl = parsed_feed['feed'].get('ttl')
+        for feed_item in parsed_feed['items']:
+            if (feed_item.get('guid'), feed_item.get('link')) not in yielded:
+                yield feed_item
 
-        response = open_url('GET', self.url)
-        if not response:
-            log.warning('Fetching feed %s failed' % (self.url))
+    relevant_headers = ('etag', 'last-modified')
+    history_length = 10
+    full_pass_interval = 86400
+    def new_items(self):
+        '''
+        Yield the items that have not been seen before. Marking them as
+        seen is left to the caller, once they have been delivered, and
+        commit has to be called after all of them have been handled.
+
+        Items that do not pass the filter rules or are older than
+        not_older_than are collected in rejected instead, the caller marks
+        them as seen as well. Once they are, their updates are not looked
+        at again. New items after the first max_items are left for the
+        next run.
+
+        With early_stop the rest of the feed is skipped after that many
+        items in a row have been seen before, which assumes the newest
+        items come first. Once a day the whole feed is looked at anyway,
+        see commit.
+        '''
+
+        if not self.fetched:
+            self.fetch()
+
+        self.parsed = False
+        self.stopped_early = False
+        self.current = set()
+        self.rejected = []
+        self.new = 0
+        self.capped = False
+
+        if self.body is None:
             return
 
-        parsed_feed = feedparser.parse(response)
-        for item in (Item(self, feed_item) for feed_item in parsed_feed['items']):
-            if self.database.seen_before(item):
+        early_stop = self.early_stop
+        if self.polled - self.metadata().get('full_pass', 0) > self.full_pass_interval:
+            early_stop = 0
+
+        yielded = set()
+        seen_in_a_row = 0
+        items = (Item(self, feed_item) for feed_item in self.feed_items())
+        for item in stats.timed(self.url, 'parse', items):
+            stats.count(self.url, 'items_parsed')
+            # remember what the feed contains so that pruning the
+            # database does not forget about items that are still there
+            self.current.add(item.link)
+            if item.guid:
+                self.current.add(item.guid)
+
+            identity = (item.guid, item.link, item.md5sum)
+            if self.not_older_than and self.polled - item.created > self.not_older_than:
+                stats.count(self.url, 'items_too_old')
+                if identity not in yielded:
+                    self.reject(item, 'is too old')
+                yielded.add(identity)
+                continue
+            if self.rules and not self.rules.accept(item):
+                stats.count(self.url, 'items_rejected')
+                if identity not in yielded:
+                    self.reject(item, 'was rejected by the filter rules')
+                yielded.add(identity)
+                continue
+
+            with stats.timer(self.url, 'seen_before'):
+                seen = self.database.seen_before(item)
+            if seen:
                 log.info('Item %s already seen, skipping' % item.link)
+                stats.count(self.url, 'items_skipped')
+                seen_in_a_row += 1
+                if early_stop and seen_in_a_row >= early_stop:
+                    log.info('Seen %i items in a row, skipping the rest of feed %s' %
+                             (seen_in_a_row, self.url))
+                    self.stopped_early = True
+                    break
                 continue
+            seen_in_a_row = 0
 
+            # the first copy of an item that is in the feed twice has not
+            # been marked as seen yet
+            if identity in yielded:
+                continue
+            yielded.add(identity)
+
+            if self.max_items and self.new >= self.max_items:
+                log.info('Item %s is over the limit of %i items per run, leaving it '
+                         'for the next run' % (item.link, self.max_items))
+                stats.count(self.url, 'items_over_limit')
+                self.capped = True
+                continue
+
+            self.new += 1
+            stats.count(self.url, 'items_new')
             yield item
-            self.database.mark_seen(item)
 
-        data = dict((key, value) for key, value in response.getheaders() if key in self.relevant_headers)
-        if data:
-            self.database.set_feed_metadata(self.url, data)
+        self.parsed = True
+        self.body.close()
+
+    def reject(self, item, reason):
+        # items that are known already are not marked again, that would
+        # only replace their message ids
+        if not self.database.known(item):
+            log.info('Item %s %s, skipping' % (item.link, reason))
+            self.rejected.append(item)
+
+    def commit(self, delivered = True):
+        with stats.timer(self.url, 'commit'):
+            self.save_metadata(delivered)
+
+    def save_metadata(self, delivered):
+        metadata = self.metadata()
+        metadata['polled'] = self.polled
+        metadata['hint'] = self.poll_hint()
+
+        # feeds that keep failing are retried less and less often, so
+        # dead ones do not cost a timeout on every run
+        if self.error:
+            failures = metadata.get('failures', 0) + 1
+            backoff = min(self.min_retry_interval * 2 ** (failures - 1),
+                          self.max_retry_interval)
+            metadata['failures'] = failures
+            metadata['last_error'] = self.error
+            metadata['retry'] = self.polled + max(backoff, min(metadata['hint'],
+                                                               self.max_retry_interval))
+            if backoff == self.max_retry_interval:
+                log.warning('Feed %s failed %i times in a row, retrying in %i seconds' %
+                            (self.url, failures, metadata['retry'] - self.polled))
+        else:
+            for key in ('failures', 'last_error', 'retry'):
+                metadata.pop(key, None)
+
+        if self.parsed:
+            # without the validators the next poll downloads the feed
+            # again, so items that could not be delivered, or were over
+            # the limit of items per run, are retried
+            for key in self.relevant_headers:
+                metadata.pop(key, None)
+            if delivered and not self.capped:
+                metadata.update((key, value) for key, value in self.headers
+                                if key in self.relevant_headers)
+            # the items after an early stop were not looked at, so the
+            # ones that were there before are assumed to still be there
+            if self.stopped_early:
+                self.current.update(metadata.get('current', []))
+            else:
+                metadata['full_pass'] = self.polled
+            # the items over the limit come after ones that are seen now,
+            # early_stop must not skip them in the next run
+            if self.capped:
+                metadata.pop('full_pass', None)
+            metadata['current'] = list(self.current)
+            metadata['hint'] = self.poll_hint(self.ttl)
+
+            # when new items showed up, used to adapt the polling interval
+            if self.new:
+                metadata['history'] = (metadata.get('history', []) +
+                                       [self.polled])[-self.history_length:]
+
+        self.database.set_feed_metadata(self.url, metadata)
+        self.database.commit()
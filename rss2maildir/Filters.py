@@ -0,0 +1,84 @@
+# coding=utf-8
+
+# rss2maildir.py - RSS feeds to Maildir 1 email per item
+# Copyright (C) 2011  Justus Winter <4winter@informatik.uni-hamburg.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import time
+
+from .utils import parse_duration
+
+actions = ('include', 'exclude')
+fields = ('title', 'author', 'link', 'categories', 'age')
+
+class Rule(object):
+    '''
+    Rule matches a field of an item against a regular expression, or,
+    for age, matches items that are older than a duration.
+    '''
+
+    def __init__(self, action, field, pattern):
+        self.action = action
+        self.field = field
+        if field == 'age':
+            self.max_age = parse_duration(pattern)
+        else:
+            self.regex = re.compile(pattern.decode('utf-8'), re.UNICODE)
+
+    def matches(self, item, now):
+        if self.field == 'age':
+            return now - item.created > self.max_age
+        if self.field == 'categories':
+            return any(self.regex.search(category) for category in item.categories)
+        return self.regex.search(getattr(item, self.field) or u'') is not None
+
+    def accepts(self, item, now):
+        return self.matches(item, now) == (self.action == 'include')
+
+def parse_rule(line):
+    parts = line.split(None, 2)
+    if len(parts) != 3 or parts[0] not in actions or parts[1] not in fields:
+        raise ValueError('Invalid filter rule %r, expected include or exclude, '
+                         'one of %s and a pattern' % (line, ', '.join(fields)))
+
+    try:
+        return Rule(*parts)
+    except re.error as e:
+        raise ValueError('Invalid filter rule %r: %s' % (line, str(e)))
+
+class FilterRules(object):
+    '''
+    FilterRules holds the filters option of a feed, one rule per line:
+
+    exclude title sponsored      drop items whose title matches
+    include categories ^python$  drop items that do not match
+    exclude age 30 days          drop items older than 30 days
+
+    Items have to pass every rule to be kept. The rules only look at what
+    the feed says about an item, so Feed.new_items applies them before
+    the item is looked up in the database.
+    '''
+
+    def __init__(self, text):
+        self.rules = [parse_rule(line.strip()) for line in text.splitlines()
+                      if line.strip() and not line.strip().startswith('#')]
+
+    def __len__(self):
+        return len(self.rules)
+
+    def accept(self, item):
+        now = time.time()
+        return all(rule.accepts(item, now) for rule in self.rules)
@@ -19,6 +19,38 @@
 import textwrap
 from HTMLParser import HTMLParser
 
+class OutputBuffer(object):
+    '''
+    OutputBuffer collects text in a list instead of growing a string.
+    It keeps track of the last two characters so that the checks for
+    trailing newlines do not have to look at the whole text.
+    '''
+
+    def __init__(self):
+        self.parts = []
+        self.length = 0
+        self.tail = u''
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        # only the last two characters can be looked at
+        if index >= 0 or -index > len(self.tail):
+            raise IndexError(index)
+        return self.tail[index]
+
+    def write(self, text):
+        if text:
+            self.parts.append(text)
+            self.length += len(text)
+            self.tail = (self.tail + text[-2:])[-2:]
+
+    def getvalue(self):
+        value = u''.join(self.parts)
+        self.parts = [value]
+        return value
+
 class HTML2Text(HTMLParser):
     '''
     HTML2Text parses html fragments to a reStructuredText like
@@ -183,8 +215,9 @@ class HTML2Text(HTMLParser):
     ]
 
     def __init__(self, textwidth = 70):
-        self.text = u''
-        self.curdata = u''
+        self.text = OutputBuffer()
+        self.curdata = []
+        self.curdatablank = True
         self.textwidth = textwidth
         self.opentags = []
         self.indentlevel = 0
@@ -194,6 +227,21 @@ class HTML2Text(HTMLParser):
         self.images = {}
         HTMLParser.__init__(self)
 
+    def add_curdata(self, data):
+        if data:
+            self.curdata.append(data)
+            if self.curdatablank and data.strip():
+                self.curdatablank = False
+
+    def get_curdata(self):
+        curdata = u''.join(self.curdata)
+        self.curdata = [curdata]
+        return curdata
+
+    def reset_curdata(self):
+        self.curdata = []
+        self.curdatablank = True
+
     def handle_starttag(self, tag, attrs):
         tag_name = tag.lower()
         if tag_name in self.blockleveltags:
@@ -248,7 +296,7 @@ class HTML2Text(HTMLParser):
                 for attr in attrs:
                     if attr[0].lower() == 'href':
                         self.urls.append(attr[1].decode('utf-8'))
-                self.curdata = self.curdata + '`'
+                self.add_curdata('`')
                 self.opentags.append(tag_name)
                 return
             elif tag_name == 'img':
@@ -286,27 +334,22 @@ class HTML2Text(HTMLParser):
             if alt:
                 if self.images.has_key(alt):
                     if self.images[alt]["url"] == url:
-                        self.curdata = self.curdata \
-                            + '|%s|' %(alt,)
+                        self.add_curdata('|%s|' %(alt,))
                     else:
                         while self.images.has_key(alt):
                             alt = alt + "_"
                         self.images[alt] = {"url": url}
-                        self.curdata = self.curdata \
-                            + '|%s|' %(alt,)
+                        self.add_curdata('|%s|' %(alt,))
                 else:
                     self.images[alt] = {"url": url}
-                    self.curdata = self.curdata \
-                        + '|%s|' %(alt,)
+                    self.add_curdata('|%s|' %(alt,))
             else:
                 if self.images.has_key(url):
-                    self.curdata = self.curdata \
-                        + '|%s|' %(url,)
+                    self.add_curdata('|%s|' %(url,))
                 else:
                     self.images[url] = {}
                     self.images[url]["url"] =url
-                    self.curdata = self.curdata \
-                        + '|%s|' %(url,)
+                    self.add_curdata('|%s|' %(url,))
 
     def handle_curdata(self):
         if len(self.opentags) == 0:
@@ -319,15 +362,17 @@ class HTML2Text(HTMLParser):
 
         if tag_thats_done == 'br':
             if len(self.text) == 0 or self.text[-1] != '\n':
-                self.text = self.text + '\n'
+                self.text.write('\n')
                 self.ignorenodata = True
             return
 
-        if len(self.curdata.strip()) == 0:
+        if self.curdatablank:
             return
 
+        curdata = self.get_curdata()
+
         if tag_thats_done in self.blockleveltags:
-            newlinerequired = self.text != u''
+            newlinerequired = len(self.text) > 0
             if self.ignorenodata:
                 newlinerequired = False
             self.ignorenodata = False
@@ -335,16 +380,16 @@ class HTML2Text(HTMLParser):
                 if tag_thats_done in ['dt', 'dd', 'li'] \
                     and len(self.text) > 1 \
                     and self.text[-1] != '\n':
-                        self.text = self.text + '\n'
+                        self.text.write('\n')
                 elif len(self.text) > 2 \
                     and self.text[-1] != '\n' \
                     and self.text[-2] != '\n':
-                    self.text = self.text + '\n\n'
+                    self.text.write('\n\n')
 
         if tag_thats_done in ["h1", "h2", "h3", "h4", "h5", "h6"]:
             underline = u''
             underlinechar = '='
-            headingtext = " ".join(self.curdata.split())
+            headingtext = " ".join(curdata.split())
             seperator = '\n' + ' '*self.indentlevel
             headingtext = seperator.join( \
                 textwrap.wrap( \
@@ -364,42 +409,38 @@ class HTML2Text(HTMLParser):
             else:
                 underline = ' ' * self.indentlevel \
                     + underlinechar * len(headingtext)
-            self.text = self.text \
-                + headingtext + '\n' \
-                + underline
+            self.text.write(headingtext + '\n' + underline)
         elif tag_thats_done in ['p', 'div']:
             paragraph = unicode( \
-                " ".join(self.curdata.strip().encode("utf-8").split()), \
+                " ".join(curdata.strip().encode("utf-8").split()), \
                 "utf-8")
             seperator = '\n' + ' ' * self.indentlevel
-            self.text = self.text \
-                + ' ' * self.indentlevel \
+            self.text.write(' ' * self.indentlevel \
                 + seperator.join( \
                     textwrap.wrap( \
-                        paragraph, self.textwidth - self.indentlevel))
+                        paragraph, self.textwidth - self.indentlevel)))
         elif tag_thats_done == "pre":
-            self.text = self.text + unicode( \
-                self.curdata.encode("utf-8"), "utf-8")
+            self.text.write(unicode( \
+                curdata.encode("utf-8"), "utf-8"))
         elif tag_thats_done == 'blockquote':
             quote = unicode( \
-                " ".join(self.curdata.encode("utf-8").strip().split()), \
+                " ".join(curdata.encode("utf-8").strip().split()), \
                 "utf-8")
             seperator = '\n' + ' ' * self.indentlevel + '    '
             if len(self.text) > 0 and self.text[-1] != '\n':
-                self.text = self.text + '\n'
-            self.text = self.text \
-                + '    ' \
+                self.text.write('\n')
+            self.text.write('    ' \
                 + seperator.join( \
                     textwrap.wrap( \
                         quote, \
                         self.textwidth - self.indentlevel - 2 \
                     )
-                )
-            self.curdata = u''
+                ))
+            self.reset_curdata()
         elif tag_thats_done == "li":
-            item = unicode(self.curdata.encode("utf-8").strip(), "utf-8")
+            item = unicode(curdata.encode("utf-8").strip(), "utf-8")
             if len(self.text) > 0 and self.text[-1] != '\n':
-                self.text = self.text + '\n'
+                self.text.write('\n')
             # work out if we're in an ol rather than a ul
             latesttags = self.opentags[-4:]
             latesttags.reverse()
@@ -424,56 +465,53 @@ class HTML2Text(HTMLParser):
             seperator = '\n' \
                 + ' ' * self.indentlevel \
                 + ' ' * listindent
-            self.text = self.text \
-                + ' ' * self.indentlevel \
+            self.text.write(' ' * self.indentlevel \
                 + listmarker \
                 + seperator.join( \
                     textwrap.wrap( \
                         item, \
                         self.textwidth - self.indentlevel - listindent \
                     ) \
-                )
-            self.curdata = u''
+                ))
+            self.reset_curdata()
         elif tag_thats_done == 'dt':
             definition = unicode(" ".join( \
-                    self.curdata.encode("utf-8").strip().split()), \
+                    curdata.encode("utf-8").strip().split()), \
                 "utf-8")
             if len(self.text) > 0 and self.text[-1] != '\n':
-                self.text = self.text + '\n\n'
+                self.text.write('\n\n')
             elif len(self.text) > 1 and self.text[-2] != '\n':
-                self.text = self.text + '\n'
+                self.text.write('\n')
             definition = ' ' * (self.indentlevel - 4) + definition + "::"
             indentstring = '\n' + ' ' * (self.indentlevel - 3)
-            self.text = self.text \
-                + indentstring.join(
+            self.text.write(indentstring.join(
                     textwrap.wrap(definition, \
-                        self.textwidth - self.indentlevel - 4))
-            self.curdata = u''
+                        self.textwidth - self.indentlevel - 4)))
+            self.reset_curdata()
         elif tag_thats_done == 'dd':
             definition = unicode(" ".join( \
-                    self.curdata.encode("utf-8").strip().split()),
+                    curdata.encode("utf-8").strip().split()),
                 "utf-8")
             if len(definition) > 0:
                 if len(self.text) > 0 and self.text[-1] != '\n':
-                    self.text = self.text + '\n'
+                    self.text.write('\n')
                 indentstring = '\n' + ' ' * self.indentlevel
-                self.text = self.text \
-                    + indentstring \
+                self.text.write(indentstring \
                     + indentstring.join( \
                         textwrap.wrap( \
                             definition, \
                             self.textwidth - self.indentlevel \
                             ) \
-                        )
-                self.curdata = u''
+                        ))
+                self.reset_curdata()
         elif tag_thats_done == 'a':
-            self.curdata = self.curdata + '`__'
+            self.add_curdata('`__')
             pass
         elif tag_thats_done in self.liststarttags:
             pass
 
         if tag_thats_done in self.blockleveltags:
-            self.curdata = u''
+            self.reset_curdata()
 
         self.ignorenodata = False
 
@@ -531,7 +569,7 @@ class HTML2Text(HTMLParser):
     def handle_data(self, data):
         if len(self.opentags) == 0:
             self.opentags.append('p')
-        self.curdata = self.curdata + data.decode("utf-8")
+        self.add_curdata(data.decode("utf-8"))
 
     def handle_charref(self, name):
         try:
@@ -544,8 +582,8 @@ class HTML2Text(HTMLParser):
                     entity = '#%s' %(name,)
             else:
                 entity = '#%s' %(name,)
-        self.curdata = self.curdata + unicode(entity.encode('utf-8'), \
-            "utf-8")
+        self.add_curdata(unicode(entity.encode('utf-8'), \
+            "utf-8"))
 
     def handle_entityref(self, name):
         entity = name
@@ -554,25 +592,29 @@ class HTML2Text(HTMLParser):
         else:
             entity = "&" + name + ";"
 
-        self.curdata = self.curdata + unicode(entity.encode('utf-8'), \
-            "utf-8")
+        self.add_curdata(unicode(entity.encode('utf-8'), \
+            "utf-8"))
 
     def gettext(self):
         self.handle_curdata()
         if len(self.text) == 0 or self.text[-1] != '\n':
-            self.text = self.text + '\n'
+            self.text.write('\n')
         self.opentags = []
-        if len(self.text) > 0:
-            while len(self.text) > 1 and self.text[-1] == '\n':
-                self.text = self.text[:-1]
-            self.text = self.text + '\n'
+        text = self.text.getvalue()
+        if len(text) > 0:
+            # keep exactly one trailing newline, or two if there is
+            # nothing else
+            stripped = text.rstrip('\n')
+            text = (stripped or text[0]) + '\n'
         if len(self.urls) > 0:
-            self.text = self.text + '\n__ ' + '\n__ '.join(self.urls) + '\n'
+            text = text + '\n__ ' + '\n__ '.join(self.urls) + '\n'
             self.urls = []
         if len(self.images.keys()) > 0:
-            self.text = self.text + '\n.. ' \
+            text = text + '\n.. ' \
                 + '\n.. '.join( \
                     ["|%s| image:: %s" %(a, self.images[a]["url"]) \
                 for a in self.images.keys()]) + '\n'
             self.images = {}
-        return self.text
+        self.text = OutputBuffer()
+        self.text.write(text)
+        return text
@@ -18,21 +18,40 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os
+import sys
+import time
 import email
-import socket
+import base64
+import random
+import logging
+import calendar
 import datetime
 
 from .HTML2Text import HTML2Text
-from .utils import generate_random_string, compute_hash
+from .RenderCache import render_cache
+from .utils import generate_random_string, compute_hash, hostname
+
+log = logging.getLogger('rss2maildir:Item')
 
 class Item(object):
+    '''
+    Item wraps an entry of a feed. Most items turn out to be seen
+    before, so everything that is not needed to find that out, like the
+    dates and the message id, is only worked out when it is used.
+    '''
+
+    __slots__ = ('feed', 'feed_item', 'author', 'title', 'link', 'guid', 'content',
+                 'previous_message_id', '_categories', '_md5sum', '_created',
+                 '_createddate', '_message_id')
+
     def __init__(self, feed, feed_item):
         self.feed = feed
+        self.feed_item = feed_item
 
         self.author = feed_item.get('author', self.feed.url)
         self.title = feed_item['title']
         self.link = feed_item['link']
+        self.guid = feed_item.get('guid', None)
 
         if feed_item.has_key('content'):
             self.content = feed_item['content'][0]['value']
@@ -42,103 +61,247 @@ class Item(object):
             else:
                 self.content = u''
 
-        self.md5sum = compute_hash(self.content.encode('utf-8'))
+        self.previous_message_id = None
+        self._categories = None
+        self._md5sum = None
+        self._created = None
+        self._createddate = None
+        self._message_id = None
 
-        self.guid = feed_item.get('guid', None)
-        if self.guid:
-            self.db_guid_key = (self.feed.url + u'|' + self.guid).encode('utf-8')
-        else:
-            self.db_guid_key = None
+    @property
+    def categories(self):
+        if self._categories is None:
+            self._categories = [tag['term'] for tag in self.feed_item.get('tags', [])
+                                if tag.get('term')]
+        return self._categories
 
-        self.db_link_key = (self.feed.url + u'|' + feed_item['link']).encode('utf-8')
+    @property
+    def md5sum(self):
+        if self._md5sum is None:
+            self._md5sum = compute_hash(self.content.encode('utf-8'))
+        return self._md5sum
 
-        self.createddate = datetime.datetime.now().strftime('%a, %e %b %Y %T -0000')
-        updated_parsed = feed_item['updated_parsed'][0:6]
+    def parse_date(self):
+        self._created = int(time.time())
+        self._createddate = datetime.datetime.now().strftime('%a, %e %b %Y %T -0000')
+
+        updated_parsed = self.feed_item.get('updated_parsed')
+        if updated_parsed is None:
+            return
+        updated_parsed = updated_parsed[0:6]
         try:
-            self.createddate = datetime.datetime(*updated_parsed) \
+            self._createddate = datetime.datetime(*updated_parsed) \
                 .strftime('%a, %e %b %Y %T -0000')
+            self._created = calendar.timegm(updated_parsed)
         except TypeError as e:
             log.warning('Parsing date %s failed: %s' % (updated_parsed, str(e)))
 
-        self.previous_message_id = None
-        self.message_id = '<%s.%s@%s>' % (
-            datetime.datetime.now().strftime("%Y%m%d%H%M"),
-            generate_random_string(6),
-            socket.gethostname()
-        )
-
-    def __getitem__(self, key):
-        return getattr(self, key)
-
-    text_template = u'%(text_content)s\n\nItem URL: %(link)s'
-    html_template = u'%(html_content)s\n<p>Item URL: <a href="%(link)s">%(link)s</a></p>'
-    def create_message(self, include_html_part = True, item_filters=None):
+    @property
+    def created(self):
+        if self._created is None:
+            self.parse_date()
+        return self._created
 
-        item = self
-        if item_filters:
-            for item_filter in item_filters:
-                item = item_filter(item)
-                if not item:
-                    return False
+    @property
+    def createddate(self):
+        if self._createddate is None:
+            self.parse_date()
+        return self._createddate
 
-                
-        message = email.MIMEMultipart.MIMEMultipart('alternative')
+    @property
+    def message_id(self):
+        if self._message_id is None:
+            self._message_id = '<%s.%s@%s>' % (
+                datetime.datetime.now().strftime("%Y%m%d%H%M"),
+                generate_random_string(6),
+                hostname
+            )
+        return self._message_id
 
-        message.set_unixfrom('%s <rss2maildir@localhost>' % item.feed.url)
-        message.add_header('From', '%s <rss2maildir@localhost>' % item.author)
-        message.add_header('To', '%s <rss2maildir@localhost>' % item.feed.url)
+    @message_id.setter
+    def message_id(self, value):
+        self._message_id = value
 
-        subj_gen = HTML2Text()
-        title = item.title.replace(u'<', u'&lt;').replace(u'>', u'&gt;')
-        subj_gen.feed(title.encode('utf-8'))
-        message.add_header('Subject', subj_gen.gettext().strip())
+    def __getitem__(self, key):
+        return getattr(self, key)
 
-        message.add_header('Message-ID', item.message_id)
-        if item.previous_message_id:
-            message.add_header('References', item.previous_message_id)
+    textwidth = 70
 
-        message.add_header('Date', item.createddate)
-        message.add_header('X-rss2maildir-rundate',
-                       datetime.datetime.now().strftime('%a, %e %b %Y %T -0000'))
+    @staticmethod
+    def render(html, textwidth):
+        textparser = HTML2Text(textwidth)
+        textparser.feed(html.encode('utf-8'))
+        return textparser.gettext()
 
-        textpart = email.MIMEText.MIMEText((item.text_template % item).encode('utf-8'),
-                                           'plain', 'utf-8')
-        message.set_default_type('text/plain')
-        message.attach(textpart)
+    @property
+    def escaped_title(self):
+        return self.title.replace(u'<', u'&lt;').replace(u'>', u'&gt;')
 
-        if include_html_part:
-            htmlpart = email.MIMEText.MIMEText((item.html_template % item).encode('utf-8'),
-                                               'html', 'utf-8')
-            message.attach(htmlpart)
+    def render_keys(self):
+        # item filters may have changed the content, so it is hashed
+        # again instead of using md5sum
+        return (('subject', compute_hash(self.escaped_title.encode('utf-8')),
+                 self.textwidth),
+                ('text', compute_hash(self.content.encode('utf-8')),
+                 self.textwidth))
 
-        return message
+    @property
+    def subject(self):
+        return render_cache.get(self.render_keys()[0], lambda:
+                                self.render(self.escaped_title, self.textwidth).strip())
 
     @property
     def text_content(self):
-        textparser = HTML2Text()
-        textparser.feed(self.content.encode('utf-8'))
-        return textparser.gettext()
+        return render_cache.get(self.render_keys()[1], lambda:
+                                self.render(self.content, self.textwidth))
+
+    def message_fields(self, include_html_part = True):
+        '''
+        Everything render_message needs to build the mail for this item,
+        as plain values that can be sent to a render worker process.
+        Conversions found in the render cache are filled in already.
+        '''
+
+        subject_key, text_key = self.render_keys()
+        return {
+            'feed_url': self.feed.url,
+            'author': self.author,
+            'title': self.escaped_title,
+            'link': self.link,
+            'content': self.content,
+            'message_id': self.message_id,
+            'previous_message_id': self.previous_message_id,
+            'createddate': self.createddate,
+            'textwidth': self.textwidth,
+            'include_html_part': include_html_part,
+            'subject': render_cache.lookup(subject_key),
+            'text_content': render_cache.lookup(text_key),
+        }
+
+    def remember_rendered(self, subject, text_content):
+        subject_key, text_key = self.render_keys()
+        render_cache.store(subject_key, subject)
+        render_cache.store(text_key, text_content)
 
     @property
     def html_content(self):
         return self.content
 
-    def deliver(self, message, maildir):
-        # start by working out the filename we should be writting to, we do
-        # this following the normal maildir style rules
-        file_name = '%i.%s.%s.%s' % (
-            os.getpid(),
-            socket.gethostname(),
-            generate_random_string(10),
-            datetime.datetime.now().strftime('%s')
-        )
-
-        tmp_path = os.path.join(maildir, 'tmp', file_name)
-        handle = open(tmp_path, 'w')
-        handle.write(message.as_string())
-        handle.close()
-
-        # now move it in to the new directory
-        new_path = os.path.join(maildir, 'new', file_name)
-        os.link(tmp_path, new_path)
-        os.unlink(tmp_path)
+text_template = u'%(text_content)s\n\nItem URL: %(link)s'
+html_template = u'%(content)s\n<p>Item URL: <a href="%(link)s">%(link)s</a></p>'
+
+def message_headers(fields, subject, rundate):
+    headers = [
+        ('From', u'%s <rss2maildir@localhost>' % fields['author']),
+        ('To', u'%s <rss2maildir@localhost>' % fields['feed_url']),
+        ('Subject', subject),
+        ('Message-ID', fields['message_id']),
+    ]
+    if fields['previous_message_id']:
+        headers.append(('References', fields['previous_message_id']))
+    headers.append(('Date', fields['createddate']))
+    headers.append(('X-rss2maildir-rundate', rundate))
+    return headers
+
+def message_parts(fields, text_content):
+    values = dict(fields, text_content = text_content)
+    parts = [('plain', text_template % values)]
+    if fields['include_html_part']:
+        parts.append(('html', html_template % values))
+    return parts
+
+def build_message(fields, subject, text_content, rundate):
+    message = email.MIMEMultipart.MIMEMultipart('alternative')
+    message.set_unixfrom('%s <rss2maildir@localhost>' % fields['feed_url'])
+
+    for name, value in message_headers(fields, subject, rundate):
+        message.add_header(name, value)
+
+    message.set_default_type('text/plain')
+    for subtype, text in message_parts(fields, text_content):
+        message.attach(email.MIMEText.MIMEText(text.encode('utf-8'), subtype, 'utf-8'))
+
+    return message
+
+def format_header(name, value):
+    # non ascii values become base64 encoded words of at most 39 bytes
+    # of utf-8 each, ascii values are folded at spaces, so lines stay
+    # shorter than 78 characters where possible. Line breaks, like the
+    # ones HTML2Text puts into long subjects, become spaces.
+    value = value.replace('\r\n', ' ').replace('\n', ' ').replace('\r', ' ')
+    if isinstance(value, unicode):
+        try:
+            value = value.encode('ascii')
+        except UnicodeEncodeError:
+            words = ['']
+            for char in value:
+                char = char.encode('utf-8')
+                if len(words[-1]) + len(char) > 39:
+                    words.append('')
+                words[-1] += char
+            return '%s: %s' % (name, '\n '.join('=?utf-8?b?%s?=' % base64.b64encode(word)
+                                                for word in words))
+
+    lines = ['%s:' % name]
+    for word in value.split(' '):
+        if len(lines[-1]) + len(word) >= 78 and lines[-1].strip(' '):
+            lines.append('')
+        lines[-1] += ' ' + word
+    if max(len(line) for line in lines) > 998:
+        return None
+    return '\n'.join(lines)
+
+part_template = ('--%s\n'
+                 'Content-Type: text/%s; charset="utf-8"\n'
+                 'MIME-Version: 1.0\n'
+                 'Content-Transfer-Encoding: base64\n'
+                 '\n'
+                 '%s')
+
+def serialize_message(fields, subject, text_content, rundate):
+    '''
+    Produce the same mail build_message does, without the email
+    package. Returns None for header values it cannot fold to fit into
+    998 characters a line, the email package has to take care of those.
+    '''
+
+    boundary = '=' * 15 + '%d' % random.randrange(sys.maxint) + '=='
+    lines = ['Content-Type: multipart/alternative;\n boundary="%s"' % boundary,
+             'MIME-Version: 1.0']
+    for name, value in message_headers(fields, subject, rundate):
+        line = format_header(name, value)
+        if line is None:
+            return None
+        lines.append(line)
+    lines.append('')
+
+    for subtype, text in message_parts(fields, text_content):
+        lines.append(part_template % (boundary, subtype,
+                                      base64.encodestring(text.encode('utf-8'))))
+    lines.append('--%s--' % boundary)
+    return '\n'.join(lines)
+
+def render_message(fields):
+    '''
+    Build the mail for an item from Item.message_fields and return its
+    subject, its text, the mail itself and the seconds spent converting
+    html to text and building the mail. This is what the render workers
+    run, so it must only depend on the fields.
+    '''
+
+    start = time.time()
+    subject = fields['subject']
+    if subject is None:
+        subject = Item.render(fields['title'], fields['textwidth']).strip()
+    text_content = fields['text_content']
+    if text_content is None:
+        text_content = Item.render(fields['content'], fields['textwidth'])
+    rendered = time.time()
+
+    rundate = datetime.datetime.now().strftime('%a, %e %b %Y %T -0000')
+    data = serialize_message(fields, subject, text_content, rundate)
+    if data is None:
+        data = build_message(fields, subject, text_content, rundate).as_string()
+
+    timings = {'html2text': rendered - start, 'message': time.time() - rendered}
+    return subject, text_content, data, timings
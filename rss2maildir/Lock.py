@@ -0,0 +1,102 @@
+# coding=utf-8
+
+# rss2maildir.py - RSS feeds to Maildir 1 email per item
+# Copyright (C) 2011  Justus Winter <4winter@informatik.uni-hamburg.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import fcntl
+import errno
+import threading
+
+from .utils import mkdir_p, compute_hash
+
+class FileLock(object):
+    '''
+    FileLock is an advisory lock on a file. It is taken with flock, so
+    the operating system releases it if the process dies.
+    '''
+
+    poll_interval = 0.2
+
+    def __init__(self, path):
+        self.path = path
+        self.handle = None
+
+    def acquire(self, exclusive = True, timeout = 0):
+        '''
+        Take the lock, shared or exclusive, waiting up to timeout seconds
+        for it, or forever if timeout is None. Returns whether the lock
+        was taken.
+        '''
+
+        if self.handle is None:
+            self.handle = open(self.path, 'a')
+
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(self.handle.fileno(), operation | fcntl.LOCK_NB)
+                return True
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+
+            if deadline is not None and time.time() >= deadline:
+                self.release()
+                return False
+            time.sleep(self.poll_interval)
+
+    def release(self):
+        if self.handle is not None:
+            # closing the file drops the lock
+            self.handle.close()
+            self.handle = None
+
+class Leases(object):
+    '''
+    Leases are exclusive locks on single feeds, kept in the leases
+    directory of the state dir. Runs that share the state dir take the
+    lease on a feed before they poll it and skip feeds another run holds
+    the lease on, so they can work on different feeds at the same time.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.held = {}
+        self.lock = threading.Lock()
+        mkdir_p(path)
+
+    def acquire(self, url):
+        lease = FileLock(os.path.join(self.path, compute_hash(url)))
+        if not lease.acquire():
+            return False
+        with self.lock:
+            self.held[url] = lease
+        return True
+
+    def release(self, url):
+        with self.lock:
+            lease = self.held.pop(url, None)
+        if lease:
+            lease.release()
+
+    def release_all(self):
+        with self.lock:
+            held, self.held = self.held, {}
+        for lease in held.values():
+            lease.release()
@@ -0,0 +1,137 @@
+# coding=utf-8
+
+# rss2maildir.py - RSS feeds to Maildir 1 email per item
+# Copyright (C) 2011  Justus Winter <4winter@informatik.uni-hamburg.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+
+from .utils import generate_random_string, hostname
+
+def fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class FlushError(OSError):
+    '''
+    FlushError is raised by Maildir.flush if not all of the messages
+    could be moved to new/, moved is how many of them were, in the order
+    they were added.
+    '''
+
+    def __init__(self, message, moved):
+        OSError.__init__(self, message)
+        self.moved = moved
+
+class Maildir(object):
+    '''
+    Maildir delivers messages to a maildir created by make_maildir.
+    Messages are written to tmp/ and renamed into new/ once they are
+    complete. How much is done to make them survive a crash depends on
+    fsync:
+
+    none     nothing, the operating system writes them out eventually
+    batch    messages are collected, flush fsyncs all of them, moves
+             them to new/ and fsyncs new/ once
+    message  every message and new/ are fsynced right away
+    '''
+
+    modes = ('none', 'batch', 'message')
+
+    def __init__(self, path, fsync = 'batch', batch_size = 100):
+        if fsync not in self.modes:
+            raise RuntimeError('Unknown fsync mode %s, expected one of %s' %
+                               (fsync, ', '.join(self.modes)))
+
+        self.path = path
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.pending = []
+
+    def file_name(self):
+        return '%i.%s.%s.%s' % (
+            os.getpid(),
+            hostname,
+            generate_random_string(10),
+            int(time.time())
+        )
+
+    def add(self, data):
+        '''
+        Write a message to tmp/. Unless fsync is batch it is moved to
+        new/ right away, otherwise that happens in flush.
+        '''
+
+        file_name = self.file_name()
+        tmp_path = os.path.join(self.path, 'tmp', file_name)
+        new_path = os.path.join(self.path, 'new', file_name)
+
+        handle = open(tmp_path, 'wb')
+        try:
+            handle.write(data)
+            if self.fsync == 'batch':
+                self.pending.append((handle, tmp_path, new_path))
+                return
+            if self.fsync == 'message':
+                handle.flush()
+                os.fsync(handle.fileno())
+            handle.close()
+            os.rename(tmp_path, new_path)
+        except:
+            handle.close()
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        if self.fsync == 'message':
+            fsync_directory(os.path.join(self.path, 'new'))
+
+    def batch_full(self):
+        return len(self.pending) >= self.batch_size
+
+    def flush(self):
+        '''
+        Move the messages collected in batch mode to new/. If that fails
+        the messages that were not moved are removed from tmp/, and
+        FlushError tells how many were.
+        '''
+
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+
+        try:
+            for handle, tmp_path, new_path in pending:
+                handle.flush()
+                os.fsync(handle.fileno())
+                handle.close()
+        except:
+            for handle, tmp_path, new_path in pending:
+                handle.close()
+                os.unlink(tmp_path)
+            raise
+
+        for position, (handle, tmp_path, new_path) in enumerate(pending):
+            try:
+                os.rename(tmp_path, new_path)
+            except OSError as e:
+                for handle, tmp_path, new_path in pending[position:]:
+                    os.unlink(tmp_path)
+                raise FlushError(str(e), position)
+        fsync_directory(os.path.join(self.path, 'new'))
@@ -0,0 +1,104 @@
+# coding=utf-8
+
+# rss2maildir.py - RSS feeds to Maildir 1 email per item
+# Copyright (C) 2011  Justus Winter <4winter@informatik.uni-hamburg.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import marshal
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger('rss2maildir:RenderCache')
+
+class RenderCache(object):
+    '''
+    RenderCache remembers the text HTML2Text produced for a piece of
+    html, keyed by the md5 of the html and the text width. Updated items
+    and posts that show up in several feeds are converted only once.
+    The least recently used entries are dropped once there are more
+    than size of them.
+    '''
+
+    version = 1
+
+    def __init__(self, size = 1000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries[key] = value
+            return value
+
+    def store(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last = False)
+
+    def get(self, key, render):
+        value = self.lookup(key)
+        if value is None:
+            value = render()
+            self.store(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def load(self, path):
+        try:
+            with open(path, 'rb') as handle:
+                version, entries = marshal.load(handle)
+        except IOError as e:
+            return
+        except (EOFError, ValueError, TypeError) as e:
+            log.warning('Ignoring broken render cache %s: %s' % (path, str(e)))
+            return
+
+        if version != self.version:
+            return
+
+        with self.lock:
+            for key, value in entries[-self.size:]:
+                self.entries[tuple(key)] = value
+
+    def save(self, path):
+        with self.lock:
+            entries = self.entries.items()
+
+        # an interrupted run must not leave a truncated cache behind
+        tmp_path = '%s.%i.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as handle:
+            marshal.dump((self.version, entries), handle)
+        os.rename(tmp_path, path)
+
+    def log_counters(self):
+        log.info('Render cache: %i hits, %i misses, %i entries' %
+                 (self.hits, self.misses, len(self.entries)))
+
+render_cache = RenderCache()
@@ -0,0 +1,97 @@
+# coding=utf-8
+
+# rss2maildir.py - RSS feeds to Maildir 1 email per item
+# Copyright (C) 2011  Justus Winter <4winter@informatik.uni-hamburg.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+
+# cron runs start a little earlier or later each time, feeds that are
+# due within this many seconds are polled anyway
+slack = 60
+
+def next_poll(metadata, interval, min_interval, max_interval):
+    '''
+    Work out when a feed should be polled next. If new items showed up
+    in it more than once the interval is learned from the times they
+    did, see Feed.new_items, otherwise the configured interval is used.
+    '''
+
+    if 'polled' not in metadata:
+        return 0
+
+    # set by Feed.commit while the feed is failing
+    if 'retry' in metadata:
+        return metadata['retry']
+
+    history = metadata.get('history', [])
+    if len(history) >= 2:
+        gaps = [later - earlier for earlier, later in zip(history, history[1:])]
+        # feeds that have gone quiet are polled less and less often
+        quiet = metadata['polled'] - history[-1]
+        interval = max(sum(gaps) / len(gaps), quiet) / 2
+
+    interval = min(max(interval, min_interval), max_interval)
+
+    # max-age, Retry-After and <ttl> may ask for longer intervals
+    interval = max(interval, min(metadata.get('hint', 0), max_interval))
+
+    return metadata['polled'] + interval
+
+class Scheduler(object):
+    '''
+    Scheduler keeps the feeds in a priority queue ordered by the time
+    they are due next.
+    '''
+
+    def __init__(self):
+        self.queue = []
+        self.due = {}
+
+    def schedule(self, url, when):
+        # entries are not removed from the heap when a feed is
+        # rescheduled, stale ones are skipped when they come up
+        self.due[url] = when
+        heapq.heappush(self.queue, (when, url))
+
+    def update(self, urls, when):
+        urls = set(urls)
+        for url in urls:
+            if url not in self.due:
+                self.schedule(url, when(url))
+
+        for url in self.due.keys():
+            if url not in urls:
+                del self.due[url]
+
+    def discard_stale(self):
+        while self.queue and self.due.get(self.queue[0][1]) != self.queue[0][0]:
+            heapq.heappop(self.queue)
+
+    def next_due(self):
+        self.discard_stale()
+        if self.queue:
+            return self.queue[0][0]
+        return None
+
+    def pop_due(self, now):
+        due = []
+        self.discard_stale()
+        while self.queue and self.queue[0][0] <= now:
+            when, url = heapq.heappop(self.queue)
+            del self.due[url]
+            due.append(url)
+            self.discard_stale()
+        return due
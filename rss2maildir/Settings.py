@@ -27,6 +27,42 @@ class FeedConfigParser(ConfigParser.SafeConfigParser):
         ConfigParser.SafeConfigParser.__init__(self, *args, **kwargs)
         self.common_section_name = common_section_name
         self.general_section_name = general_section_name
+        self.files = []
+        self.overrides = {}
+
+    def read_defaults(self):
+        self.readfp(open(os.path.join(os.path.dirname(__file__), 'defaults', 'rss2maildir.conf')))
+
+    def read(self, filenames):
+        read = ConfigParser.SafeConfigParser.read(self, filenames)
+        self.files.extend(read)
+        return read
+
+    def reload(self, check = None):
+        '''
+        Reread the configuration files. check is called with the new
+        settings before they replace the current ones, if it raises they
+        are kept.
+        '''
+
+        # parse everything once before touching the current settings so
+        # that a broken file leaves them intact
+        fresh = FeedConfigParser(self.common_section_name, self.general_section_name)
+        fresh.read_defaults()
+        for filename in self.files:
+            fresh.readfp(open(filename))
+        for key, value in self.overrides.items():
+            fresh.set(self.general_section_name, key, value)
+
+        if check:
+            check(fresh)
+
+        for section in self.sections():
+            self.remove_section(section)
+        for section in fresh.sections():
+            self.add_section(section)
+            for key, value in fresh.items(section, raw = True):
+                self.set(section, key, value)
 
     def get(self, section, key, *args, **kwargs):
         for location in (section, self.common_section_name):
@@ -43,6 +79,8 @@ class FeedConfigParser(ConfigParser.SafeConfigParser):
         return ConfigParser.SafeConfigParser.get(self, self.general_section_name, key)
 
     def __setitem__(self, key, value):
+        # remembered so that they survive reloading the configuration
+        self.overrides[key] = value
         self.set(self.general_section_name, key, value)
 
     def feeds(self):
@@ -50,4 +88,4 @@ class FeedConfigParser(ConfigParser.SafeConfigParser):
                 if section not in (self.general_section_name, self.common_section_name))
 
 settings = FeedConfigParser()
-settings.readfp(open(os.path.join(os.path.dirname(__file__), 'defaults', 'rss2maildir.conf')))
+settings.read_defaults()
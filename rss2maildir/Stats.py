@@ -0,0 +1,183 @@
+# coding=utf-8
+
+# rss2maildir.py - RSS feeds to Maildir 1 email per item
+# Copyright (C) 2011  Justus Winter <4winter@informatik.uni-hamburg.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import json
+import logging
+import threading
+import contextlib
+
+log = logging.getLogger('rss2maildir:Stats')
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Stats(object):
+    '''
+    Stats adds up how long the stages of a run took and counts what
+    happened, per feed. Timers are in seconds. Feeds are fetched from
+    several threads at once, so the timers of a run can add up to more
+    than its duration.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.finished = None
+            self.feeds = {}
+
+    def feed(self, url):
+        return self.feeds.setdefault(url, {'timers': {}, 'counters': {}})
+
+    def add_time(self, url, name, seconds):
+        with self.lock:
+            timers = self.feed(url)['timers']
+            timers[name] = timers.get(name, 0) + seconds
+
+    def count(self, url, name, value = 1):
+        with self.lock:
+            counters = self.feed(url)['counters']
+            counters[name] = counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, url, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(url, name, time.time() - start)
+
+    def timed(self, url, name, iterable):
+        '''
+        Yield from iterable, adding the time spent waiting for each value
+        to the timer name.
+        '''
+
+        iterator = iter(iterable)
+        while True:
+            with self.timer(url, name):
+                try:
+                    value = next(iterator)
+                except StopIteration:
+                    return
+            yield value
+
+    def finish(self):
+        self.finished = time.time()
+
+    def summary(self):
+        with self.lock:
+            timers = {}
+            counters = {}
+            for feed in self.feeds.values():
+                for name, seconds in feed['timers'].items():
+                    timers[name] = timers.get(name, 0) + seconds
+                for name, value in feed['counters'].items():
+                    counters[name] = counters.get(name, 0) + value
+
+            return {
+                'started': self.started,
+                'duration': (self.finished or time.time()) - self.started,
+                'timers': timers,
+                'counters': counters,
+                'deferred': sorted(url for url, feed in self.feeds.items()
+                                   if feed['counters'].get('deferred')),
+                'feeds': dict((url, {'timers': dict(feed['timers']),
+                                     'counters': dict(feed['counters'])})
+                              for url, feed in self.feeds.items()),
+            }
+
+    def log_summary(self):
+        summary = self.summary()
+        counters = summary['counters']
+        log.info('Run took %.2fs: %i feeds, %i items parsed, %i delivered, %i bytes fetched' %
+                 (summary['duration'], len(summary['feeds']),
+                  counters.get('items_parsed', 0), counters.get('items_delivered', 0),
+                  counters.get('bytes_received', 0)))
+        deferred = summary['deferred']
+        if deferred:
+            log.warning('Deferred %i feeds to the next run: %s' %
+                        (len(deferred), ', '.join(deferred)))
+        log.info('Time spent: %s' % ', '.join('%s %.3fs' % timer for timer in
+                                              sorted(summary['timers'].items())))
+
+    def write(self, path, data):
+        # write to a temporary file first, readers must never see a
+        # partial file
+        tmp_path = '%s.%i.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as handle:
+            handle.write(data)
+        os.rename(tmp_path, path)
+
+    def write_json(self, path):
+        self.write(path, json.dumps(self.summary(), indent = 2, sort_keys = True))
+
+    def write_prometheus(self, path):
+        '''
+        Write the summary in the format of the node exporter textfile
+        collector.
+        '''
+
+        summary = self.summary()
+        lines = [
+            '# HELP rss2maildir_last_run_timestamp_seconds When the last run started.',
+            '# TYPE rss2maildir_last_run_timestamp_seconds gauge',
+            'rss2maildir_last_run_timestamp_seconds %f' % summary['started'],
+            '# HELP rss2maildir_last_run_duration_seconds How long the last run took.',
+            '# TYPE rss2maildir_last_run_duration_seconds gauge',
+            'rss2maildir_last_run_duration_seconds %f' % summary['duration'],
+            '# HELP rss2maildir_last_run_feeds Number of feeds polled in the last run.',
+            '# TYPE rss2maildir_last_run_feeds gauge',
+            'rss2maildir_last_run_feeds %i' % len(summary['feeds']),
+            '# HELP rss2maildir_stage_seconds Time spent in each stage in the last run.',
+            '# TYPE rss2maildir_stage_seconds gauge',
+        ]
+        lines.extend('rss2maildir_stage_seconds{stage="%s"} %f' % (escape_label(name), seconds)
+                     for name, seconds in sorted(summary['timers'].items()))
+        lines.extend([
+            '# HELP rss2maildir_events Counters of the last run.',
+            '# TYPE rss2maildir_events gauge',
+        ])
+        lines.extend('rss2maildir_events{event="%s"} %i' % (escape_label(name), value)
+                     for name, value in sorted(summary['counters'].items()))
+
+        lines.extend([
+            '# HELP rss2maildir_feed_stage_seconds Time spent in each stage per feed in the last run.',
+            '# TYPE rss2maildir_feed_stage_seconds gauge',
+        ])
+        for url, feed in sorted(summary['feeds'].items()):
+            lines.extend('rss2maildir_feed_stage_seconds{feed="%s",stage="%s"} %f' %
+                         (escape_label(url), escape_label(name), seconds)
+                         for name, seconds in sorted(feed['timers'].items()))
+        lines.extend([
+            '# HELP rss2maildir_feed_events Counters per feed of the last run.',
+            '# TYPE rss2maildir_feed_events gauge',
+        ])
+        for url, feed in sorted(summary['feeds'].items()):
+            lines.extend('rss2maildir_feed_events{feed="%s",event="%s"} %i' %
+                         (escape_label(url), escape_label(name), value)
+                         for name, value in sorted(feed['counters'].items()))
+
+        self.write(path, '\n'.join(lines) + '\n')
+
+stats = Stats()
@@ -0,0 +1,241 @@
+# coding=utf-8
+
+# rss2maildir.py - RSS feeds to Maildir 1 email per item
+# Copyright (C) 2011  Justus Winter <4winter@informatik.uni-hamburg.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import urlparse
+import feedparser
+from xml.sax.saxutils import escape
+from xml.etree import cElementTree as ElementTree
+
+atom = '{http://www.w3.org/2005/Atom}'
+xhtml = '{http://www.w3.org/1999/xhtml}'
+rss1 = '{http://purl.org/rss/1.0/}'
+rdf = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+content = '{http://purl.org/rss/1.0/modules/content/}'
+dc = '{http://purl.org/dc/elements/1.1/}'
+xml_base = '{http://www.w3.org/XML/1998/namespace}base'
+
+looks_like_html = re.compile(r'<[a-zA-Z/!]|&(#[0-9]+|#x[0-9a-fA-F]+|[a-zA-Z]+);')
+
+class ParseError(Exception):
+    pass
+
+def text(element):
+    return unicode(element.text or u'').strip()
+
+def clean_html(html, base):
+    # the same feedparser does to embedded markup, so that both parsers
+    # produce the same mails
+    if feedparser.RESOLVE_RELATIVE_URIS:
+        html = feedparser._resolveRelativeURIs(html, base, 'utf-8', 'text/html')
+    if feedparser.SANITIZE_HTML:
+        html = feedparser._sanitizeHTML(html, 'utf-8', 'text/html')
+    if not isinstance(html, unicode):
+        html = html.decode('utf-8', 'ignore')
+
+    # the html processors of feedparser encode non ascii characters
+    # twice, this is how feedparser itself undoes that
+    try:
+        html = html.encode('iso-8859-1').decode('utf-8')
+    except (UnicodeEncodeError, UnicodeDecodeError) as e:
+        pass
+    return html.strip()
+
+def inner_xhtml(element):
+    # atom xhtml content is wrapped in a div of the xhtml namespace
+    for child in element.iter():
+        if child.tag.startswith(xhtml):
+            child.tag = child.tag[len(xhtml):]
+
+    div = element.find('div')
+    if div is None:
+        div = element
+    return (escape(div.text or u'') +
+            u''.join(ElementTree.tostring(child, 'utf-8').decode('utf-8')
+                     for child in div))
+
+def atom_text(element, base):
+    kind = element.get('type', 'text')
+    if kind == 'xhtml':
+        return clean_html(inner_xhtml(element), base)
+    if kind in ('html', 'text/html') or kind.endswith('+xml'):
+        return clean_html(text(element), base)
+    return text(element)
+
+def rss_text(element, base):
+    value = text(element)
+    if looks_like_html.search(value):
+        return clean_html(value, base)
+    return value
+
+def resolve(base, uri):
+    # with the urljoin of feedparser, guids have to come out the same
+    # as with feedparser or items would be delivered twice
+    if not uri:
+        return uri
+    return feedparser._urljoin(base, uri)
+
+def parse_date(element):
+    if element is None:
+        return None
+    return feedparser._parse_date(text(element))
+
+class StreamingParser(object):
+    '''
+    StreamingParser reads RSS 2.0, RSS 1.0 and Atom 1.0 documents and
+    yields every item as soon as its closing tag has been read, in the
+    form feedparser returns items in as far as Item is concerned. Items
+    are dropped from the tree once they have been yielded, so memory use
+    does not grow with the size of the document.
+
+    Anything that is not well formed raises ParseError, Feed.new_items
+    falls back to feedparser then.
+    '''
+
+    root_tags = ('rss', rdf + 'RDF', atom + 'feed')
+    item_tags = ('item', rss1 + 'item', atom + 'entry')
+
+    def __init__(self, stream, base = ''):
+        self.stream = stream
+        self.base = base
+        self.feed = {}
+
+    def items(self):
+        stack = []
+        bases = [self.base]
+
+        try:
+            for event, element in ElementTree.iterparse(self.stream, ('start', 'end')):
+                if event == 'start':
+                    if not stack and element.tag not in self.root_tags:
+                        raise ParseError('%s is not an RSS or Atom document' % element.tag)
+                    stack.append(element)
+                    bases.append(urlparse.urljoin(bases[-1], element.get(xml_base, '')))
+                    continue
+
+                stack.pop()
+                base = bases.pop()
+                if element.tag in self.item_tags:
+                    if element.tag == atom + 'entry':
+                        yield self.parse_entry(element, base)
+                    else:
+                        yield self.parse_item(element, base)
+                    if stack:
+                        stack[-1].remove(element)
+                elif element.tag == 'ttl' and stack and stack[-1].tag == 'channel':
+                    self.feed['ttl'] = text(element)
+        except SyntaxError as e:
+            # cElementTree.ParseError is a SyntaxError
+            raise ParseError(str(e))
+
+    def parse_item(self, element, base):
+        ns = rss1 if element.tag.startswith(rss1) else ''
+        feed_item = {}
+
+        title = element.find(ns + 'title')
+        if title is not None:
+            feed_item['title'] = text(title)
+
+        link = element.find(ns + 'link')
+        if link is not None:
+            feed_item['link'] = resolve(base, text(link))
+
+        guid = element.find('guid')
+        if guid is not None:
+            # permalinks are resolved like links, other guids are opaque
+            if guid.get('isPermaLink', 'true') == 'true':
+                feed_item['guid'] = resolve(base, text(guid))
+                feed_item.setdefault('link', feed_item['guid'])
+            else:
+                feed_item['guid'] = text(guid)
+        elif element.get(rdf + 'about'):
+            feed_item['guid'] = element.get(rdf + 'about')
+
+        author = element.find('author')
+        if author is None:
+            author = element.find(dc + 'creator')
+        if author is not None:
+            feed_item['author'] = text(author)
+
+        tags = [{'term': text(tag)} for tag in
+                element.findall('category') + element.findall(dc + 'subject')]
+        if tags:
+            feed_item['tags'] = tags
+
+        description = element.find(ns + 'description')
+        if description is not None:
+            feed_item['description'] = rss_text(description, base)
+
+        encoded = element.find(content + 'encoded')
+        if encoded is not None:
+            feed_item['content'] = [{'value': clean_html(text(encoded), base)}]
+
+        updated = parse_date(element.find(dc + 'date')) or \
+                  parse_date(element.find('pubDate'))
+        if updated:
+            feed_item['updated_parsed'] = updated
+
+        return feed_item
+
+    def parse_entry(self, element, base):
+        feed_item = {}
+
+        title = element.find(atom + 'title')
+        if title is not None:
+            feed_item['title'] = atom_text(title, base)
+
+        for link in element.findall(atom + 'link'):
+            if link.get('rel', 'alternate') == 'alternate' and link.get('href'):
+                feed_item['link'] = resolve(base, link.get('href'))
+                break
+
+        # feedparser treats ids like permalinks
+        guid = element.find(atom + 'id')
+        if guid is not None:
+            feed_item['guid'] = resolve(base, text(guid))
+            feed_item.setdefault('link', feed_item['guid'])
+
+        author = element.find(atom + 'author')
+        if author is not None:
+            name = author.find(atom + 'name')
+            email = author.find(atom + 'email')
+            if name is not None and email is not None:
+                feed_item['author'] = u'%s (%s)' % (text(name), text(email))
+            elif name is not None or email is not None:
+                feed_item['author'] = text(name if name is not None else email)
+
+        tags = [{'term': tag.get('term')} for tag in element.findall(atom + 'category')
+                if tag.get('term')]
+        if tags:
+            feed_item['tags'] = tags
+
+        summary = element.find(atom + 'summary')
+        if summary is not None:
+            feed_item['description'] = atom_text(summary, base)
+
+        body = element.find(atom + 'content')
+        if body is not None and not body.get('src'):
+            feed_item['content'] = [{'value': atom_text(body, base)}]
+            feed_item.setdefault('description', feed_item['content'][0]['value'])
+
+        updated = parse_date(element.find(atom + 'updated')) or \
+                  parse_date(element.find(atom + 'published'))
+        if updated:
+            feed_item['updated_parsed'] = updated
+
+        return feed_item
@@ -17,21 +17,408 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import imp
+import time
+import signal
+import threading
+import functools
+import collections
 import urllib
 import logging
-import imp
+import ConfigParser
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
-from .Database import Database
+from .Database import open_database, migrate_dbm_to_sqlite
 from .Feed import Feed
+from .Filters import FilterRules
+from .Lock import FileLock, Leases
+from .Item import render_message
+from .Maildir import Maildir
+from .RenderCache import render_cache
+from .Scheduler import Scheduler, next_poll, slack
 from .Settings import settings
-from .utils import make_maildir
+from .Stats import stats
+from .utils import make_maildir, mkdir_p, connection_pool, parse_duration, parse_size
 
 log = logging.getLogger('rss2maildir')
 
-def main():
-    database = Database(os.path.expanduser(settings['state_dir']))
+def fetch_feeds(feeds, workers, claim = None, slots = None, stopped = None,
+                deadline = None):
+    '''
+    Fetch the feeds with workers threads. Returns an iterator over the
+    results and the pool, which the caller has to terminate and join,
+    after setting stopped and releasing a slot if it gives up early.
+    Feeds that are still being fetched at deadline come back deferred.
+    '''
+
+    # fetched feeds keep their bodies until they are delivered, so
+    # fetching only runs ahead while one of the slots is free. The
+    # caller releases a slot for every feed it is done with.
+    def acquire_slots(feeds):
+        for job in feeds:
+            if slots:
+                slots.acquire()
+            if stopped and stopped.is_set():
+                return
+            yield job
+
+    # feeds that are not claimed are neither fetched nor delivered
+    def fetch(job):
+        feed, maildir = job
+        claimed = claim is None or claim(feed)
+        if claimed:
+            feed.fetch()
+        return feed, maildir, claimed
+
+    if workers <= 1:
+        return (fetch(job) for job in acquire_slots(feeds)), None
+
+    # imap hands the results back in the order of the config file, so
+    # the delivery below does not depend on which server answers first
+    pool = ThreadPool(workers)
+    results = pool.imap(fetch, acquire_slots(feeds))
+    pool.close()
+
+    # but a feed that is slow to fetch must not hold up the rest past
+    # the deadline
+    def in_order(results):
+        waiting = True
+        for feed, maildir in feeds:
+            if waiting:
+                try:
+                    timeout = None
+                    if deadline is not None:
+                        timeout = max(deadline - time.time(), 0)
+                    result = results.next(timeout)
+                except multiprocessing.TimeoutError:
+                    waiting = False
+                else:
+                    yield result
+                    continue
+            feed.deferred = True
+            yield feed, maildir, True
+
+    return in_order(results), pool
+
+def filter_item(item, item_filters):
+    for item_filter in item_filters or ():
+        item = item_filter(item)
+        if not item:
+            return None
+    return item
+
+def render_items(feed, item_filters, render_pool):
+    include_html_part = settings.getboolean(feed.url, 'include_html_part')
+
+    for item in feed.new_items():
+        filtered = filter_item(item, item_filters)
+        if not filtered:
+            yield item, None, None
+            continue
+
+        fields = filtered.message_fields(include_html_part)
+        if render_pool:
+            # get with a timeout, otherwise ^C is not delivered
+            result = functools.partial(
+                render_pool.apply_async(render_message, (fields, )).get, 3600)
+        else:
+            result = functools.partial(render_message, fields)
+        yield item, filtered, result
+
+def deliver_items(feed, maildir, jobs):
+    delivered = True
+    batch = []
+    # the items whose messages wait in tmp/ for the next flush
+    added = []
+
+    def mark_seen(items):
+        with stats.timer(feed.url, 'mark_seen'):
+            for item in items:
+                feed.database.mark_seen(item)
+
+    def flush():
+        # items are only marked as seen once their messages are in new/
+        try:
+            with stats.timer(feed.url, 'deliver'):
+                maildir.flush()
+        except (IOError, OSError) as e:
+            log.warning('Delivering to %s failed: %s' % (maildir.path, str(e)))
+            # the messages that did make it to new/ must not be
+            # delivered again
+            moved = getattr(e, 'moved', 0)
+            stats.count(feed.url, 'delivery_failed', len(added) - moved)
+            mark_seen(added[:moved])
+            del batch[:]
+            del added[:]
+            return False
+
+        mark_seen(batch)
+        del batch[:]
+        del added[:]
+        return True
+
+    for item, filtered, result in jobs:
+        # items rejected by a filter are marked as seen as well, so
+        # they are not looked at again
+        if not filtered:
+            stats.count(feed.url, 'items_filtered')
+        else:
+            subject, text_content, data, timings = result()
+            filtered.remember_rendered(subject, text_content)
+            for name, seconds in timings.items():
+                stats.add_time(feed.url, name, seconds)
+            try:
+                with stats.timer(feed.url, 'deliver'):
+                    maildir.add(data)
+            except (IOError, OSError) as e:
+                log.warning('Delivering item %s to %s failed: %s' %
+                            (item.link, maildir.path, str(e)))
+                stats.count(feed.url, 'delivery_failed')
+                delivered = False
+                continue
+            stats.count(feed.url, 'items_delivered')
+            stats.count(feed.url, 'bytes_written', len(data))
+            added.append(item)
+
+        batch.append(item)
+        if maildir.batch_full():
+            delivered = flush() and delivered
+
+    # rejected by the filter rules or too old, see
+    # Feed.new_items
+    batch.extend(feed.rejected)
+    delivered = flush() and delivered
+    feed.commit(delivered)
+
+locking_modes = ('global', 'feed')
+
+def locking_mode():
+    mode = settings['locking']
+    if mode not in locking_modes:
+        raise RuntimeError('Unknown locking mode %s, expected one of %s' %
+                           (mode, ', '.join(locking_modes)))
+
+    # dbm files must never be opened by two processes at once
+    if mode == 'feed' and settings['state_backend'] != 'sqlite':
+        log.info('locking = feed needs state_backend = sqlite, using global locking')
+        return 'global'
+    return mode
+
+def lock_state_dir(exclusive = True):
+    '''
+    Take the lock on the state dir, exclusively or, for runs that share
+    it with locking = feed, shared. Returns None if another run held it
+    for longer than lock_timeout.
+    '''
+
+    path = os.path.expanduser(settings['state_dir'])
+    mkdir_p(path)
+
+    # a negative timeout waits as long as it takes
+    timeout = parse_duration(settings['lock_timeout'])
+    lock = FileLock(os.path.join(path, 'lock'))
+    if not lock.acquire(exclusive, timeout if timeout >= 0 else None):
+        log.warning('State dir %s is locked by another run' % path)
+        return None
+    return lock
+
+def migrate():
+    lock = lock_state_dir()
+    if not lock:
+        raise RuntimeError('Could not lock the state dir')
+    try:
+        migrate_dbm_to_sqlite(os.path.expanduser(settings['state_dir']),
+                              settings.feeds())
+    finally:
+        lock.release()
+
+def expire_seen_after():
+    if 'expire_seen_after' not in settings:
+        return None
+    return parse_duration(settings['expire_seen_after'])
+
+def compact():
+    lock = lock_state_dir()
+    if not lock:
+        raise RuntimeError('Could not lock the state dir')
+
+    try:
+        database = open_database(os.path.expanduser(settings['state_dir']),
+                                 settings['state_backend'])
+
+        size = database.size()
+        removed = 0
+        max_age = expire_seen_after()
+        if max_age:
+            removed = database.prune(max_age)
+        database.compact()
+        reclaimed = size - database.size()
+
+        database.close()
+    finally:
+        lock.release()
+    return removed, reclaimed
+
+def render_cache_path():
+    if not settings.getboolean(settings.general_section_name, 'persist_render_cache'):
+        return None
+    return os.path.join(os.path.expanduser(settings['state_dir']), 'render_cache')
+
+def load_render_cache():
+    path = render_cache_path()
+    if path:
+        render_cache.load(path)
+
+def save_render_cache():
+    path = render_cache_path()
+    if path:
+        try:
+            render_cache.save(path)
+        except (IOError, OSError) as e:
+            log.warning('Could not save render cache %s: %s' % (path, str(e)))
+
+def feed_due(database, url):
+    try:
+        metadata = database.get_feed_metadata(url)
+    except KeyError as e:
+        metadata = {}
+
+    return next_poll(metadata,
+                     parse_duration(settings.get(url, 'interval')),
+                     parse_duration(settings.get(url, 'min_interval')),
+                     parse_duration(settings.get(url, 'max_interval')))
+
+expiry_interval = 86400
+def expire(database, lock):
+    '''
+    Prune the seen records, holding lock, the lock on the state dir.
+    With locking = feed other runs may be delivering items of the feeds
+    whose records are pruned, so the shared lock is traded for the
+    exclusive one while pruning, and if another run holds the lock as
+    well, expiring is left for a later run.
+    '''
+
+    # pruning reads every seen record, so it is only done once a day,
+    # the modification time of last_expiry says when it was done last
+    max_age = expire_seen_after()
+    if not max_age:
+        return
+
+    stamp = os.path.join(database.path, 'last_expiry')
+    try:
+        if time.time() - os.path.getmtime(stamp) < expiry_interval:
+            return
+    except OSError as e:
+        pass
+
+    # flock cannot turn a shared lock into an exclusive one reliably
+    shared = locking_mode() == 'feed'
+    if shared:
+        lock.release()
+    try:
+        if shared and not lock.acquire(True, 0):
+            log.info('The state dir is shared with another run, not expiring seen records')
+            return
+
+        size = database.size()
+        removed = database.prune(max_age)
+        log.info('Expired %i seen records, reclaimed %i bytes' %
+                 (removed, size - database.size()))
+
+        open(stamp, 'a').close()
+        os.utime(stamp, None)
+    finally:
+        if shared:
+            lock.release()
+            lock.acquire(False, None)
+
+def write_stats():
+    stats.log_summary()
+    for option, write in (('stats_file', stats.write_json),
+                          ('prometheus_file', stats.write_prometheus)):
+        if option in settings:
+            path = os.path.expanduser(settings[option])
+            try:
+                write(path)
+            except (IOError, OSError) as e:
+                log.warning('Could not write %s: %s' % (path, str(e)))
 
-    for url in settings.feeds():
+def timeout(option):
+    # 0 means no timeout
+    return parse_duration(settings[option]) or None
+
+def check_settings(parser):
+    '''
+    Parse every option a run uses, raising ValueError for the first one
+    that is invalid. The daemon refuses to reload a configuration that
+    does not pass.
+    '''
+
+    general = parser.general_section_name
+    for option in ('lock_timeout', 'connect_timeout', 'read_timeout', 'run_deadline'):
+        parse_duration(parser.get(general, option))
+    if parser.has_option(general, 'expire_seen_after'):
+        parse_duration(parser.get(general, 'expire_seen_after'))
+    parse_size(parser.get(general, 'max_body_size'))
+    for option in ('workers', 'connections_per_host', 'delivery_batch_size',
+                   'render_workers', 'render_cache_size'):
+        parser.getint(general, option)
+    parser.getfloat(general, 'host_request_rate')
+    parser.getboolean(general, 'persist_render_cache')
+
+    if parser.get(general, 'locking') not in locking_modes:
+        raise ValueError('Unknown locking mode %s, expected one of %s' %
+                         (parser.get(general, 'locking'), ', '.join(locking_modes)))
+    if parser.get(general, 'fsync') not in Maildir.modes:
+        raise ValueError('Unknown fsync mode %s, expected one of %s' %
+                         (parser.get(general, 'fsync'), ', '.join(Maildir.modes)))
+
+    for url in parser.feeds():
+        try:
+            for option in ('interval', 'min_interval', 'max_interval',
+                           'max_retry_interval', 'not_older_than'):
+                parse_duration(parser.get(url, option))
+            for option in ('early_stop', 'max_items_per_run'):
+                parser.getint(url, option)
+            for option in ('unordered', 'streaming_parser', 'include_html_part'):
+                parser.getboolean(url, option)
+            FilterRules(parser.get(url, 'filters'))
+        except (KeyError, ValueError) as e:
+            raise ValueError('Feed %s: %s' % (url, str(e)))
+
+def claim_feed(database, leases, feed):
+    '''
+    With locking = feed, take the lease on a feed before polling it.
+    Feeds another run is polling, or has polled since this one decided
+    they were due, are skipped.
+    '''
+
+    if not leases.acquire(feed.url):
+        log.info('Feed %s is being polled by another run, skipping' % feed.url)
+        return False
+
+    if feed_due(database, feed.url) > time.time() + slack:
+        log.info('Feed %s has been polled by another run, skipping' % feed.url)
+        leases.release(feed.url)
+        return False
+    return True
+
+def run(database, urls, leases = None):
+    stats.reset()
+    fsync = settings['fsync']
+    batch_size = settings.getint(settings.general_section_name, 'delivery_batch_size')
+    max_body_size = parse_size(settings['max_body_size'])
+
+    deadline = timeout('run_deadline')
+    if deadline:
+        deadline += time.time()
+
+    # feeds sharing the same rules share the compiled ones
+    compiled_rules = {}
+
+    feeds = []
+    for url in urls:
         if settings.has_option(url, 'name'):
             name = settings.get(url, 'name')
         else:
@@ -51,20 +438,219 @@ def main():
             log.warning('Skipping feed %s' % url)
             continue
 
-        # get item filters
-        if 'item_filters' in settings:
-            item_filters = imp.load_source(
-                'item_filters',
-                settings['item_filters']).get_filters()
-
-        # right - we've got the directories, we've got the url, we know the
-        # url... lets play!
-
-        feed = Feed(database, url)
-        for item in feed.new_items():
-            message = item.create_message(
-                include_html_part=settings.getboolean(feed.url, 'include_html_part'),
-                item_filters=item_filters
-            )
-            if item:
-                item.deliver(message, maildir)
+        rules = settings.get(url, 'filters')
+        try:
+            if rules not in compiled_rules:
+                compiled_rules[rules] = FilterRules(rules)
+        except ValueError as e:
+            log.warning('Skipping feed %s: %s' % (url, str(e)))
+            continue
+
+        # feeds that do not list the newest items first would lose items
+        early_stop = settings.getint(url, 'early_stop')
+        if settings.getboolean(url, 'unordered'):
+            early_stop = 0
+
+        feeds.append((Feed(database, url,
+                           settings.getboolean(url, 'streaming_parser'),
+                           early_stop, max_body_size, deadline,
+                           parse_duration(settings.get(url, 'min_interval')),
+                           parse_duration(settings.get(url, 'max_retry_interval')),
+                           compiled_rules[rules],
+                           parse_duration(settings.get(url, 'not_older_than')),
+                           settings.getint(url, 'max_items_per_run')),
+                      Maildir(maildir, fsync, batch_size)))
+
+    workers = settings.getint(settings.general_section_name, 'workers')
+    connection_pool.max_per_host = settings.getint(
+        settings.general_section_name, 'connections_per_host')
+    connection_pool.connect_timeout = timeout('connect_timeout')
+    connection_pool.read_timeout = timeout('read_timeout')
+    connection_pool.request_rate = settings.getfloat(
+        settings.general_section_name, 'host_request_rate')
+    render_cache.size = settings.getint(
+        settings.general_section_name, 'render_cache_size')
+
+    render_workers = settings.getint(settings.general_section_name, 'render_workers')
+    render_pool = None
+    if render_workers > 1:
+        render_pool = multiprocessing.Pool(render_workers)
+
+    # with render workers the items of the next few feeds are converted
+    # while the current one is delivered, in the order of the config file
+    pending = collections.deque()
+    lookahead = render_workers if render_pool else 0
+
+    item_filters = None
+    if 'item_filters' in settings:
+        item_filters = imp.load_source('item_filters',
+                                       settings['item_filters']).get_filters()
+
+    claim = None
+    if leases:
+        claim = functools.partial(claim_feed, database, leases)
+
+    slots = threading.Semaphore(2 * max(workers, 1) + lookahead)
+    stopped = threading.Event()
+
+    def done(feed):
+        if leases:
+            leases.release(feed.url)
+        slots.release()
+
+    def deliver(feed, maildir, jobs):
+        deliver_items(feed, maildir, jobs)
+        done(feed)
+
+    results, fetch_pool = fetch_feeds(feeds, workers, claim, slots, stopped, deadline)
+    try:
+        for feed, maildir, claimed in results:
+            if not claimed:
+                done(feed)
+                continue
+
+            # feeds are only deferred before they are parsed, nothing
+            # has been written for them then and they are still due
+            if feed.deferred or feed.past_deadline():
+                log.warning('Run deadline reached, deferring feed %s' % feed.url)
+                stats.count(feed.url, 'deferred')
+                if feed.body:
+                    feed.body.close()
+                done(feed)
+                continue
+
+            # without render workers the items are converted and
+            # delivered one by one while the feed is parsed
+            jobs = render_items(feed, item_filters, render_pool)
+            if render_pool:
+                jobs = list(jobs)
+            pending.append((feed, maildir, jobs))
+            while len(pending) > lookahead:
+                deliver(*pending.popleft())
+
+        while pending:
+            deliver(*pending.popleft())
+    finally:
+        # the pool may still be waiting for a slot, and its workers must
+        # not claim feeds once the leases have been released
+        stopped.set()
+        slots.release()
+        if fetch_pool:
+            fetch_pool.terminate()
+            fetch_pool.join()
+        if render_pool:
+            render_pool.terminate()
+            render_pool.join()
+        if leases:
+            leases.release_all()
+
+    render_cache.log_counters()
+    stats.finish()
+    write_stats()
+
+def make_leases():
+    if locking_mode() != 'feed':
+        return None
+    return Leases(os.path.join(os.path.expanduser(settings['state_dir']), 'leases'))
+
+def main():
+    # runs with locking = feed share the state dir, see claim_feed
+    lock = lock_state_dir(locking_mode() == 'global')
+    if not lock:
+        log.warning('Skipping this run')
+        return
+
+    try:
+        database = open_database(os.path.expanduser(settings['state_dir']),
+                                 settings['state_backend'])
+
+        urls = []
+        now = time.time()
+        for url in settings.feeds():
+            due = feed_due(database, url)
+            if due > now + slack:
+                log.info('Feed %s is not due for %i seconds, skipping' % (url, due - now))
+                continue
+            urls.append(url)
+
+        load_render_cache()
+        run(database, urls, make_leases())
+        connection_pool.close_all()
+        save_render_cache()
+
+        expire(database, lock)
+        database.close()
+    finally:
+        lock.release()
+
+# how long the daemon waits before it retries feeds it could not schedule
+daemon_retry_interval = 300
+
+def daemon():
+    '''
+    Keep running and poll every feed once its interval has passed. A
+    SIGHUP makes the daemon reread its configuration. It holds the lock
+    on the state dir for as long as it runs.
+    '''
+
+    lock = lock_state_dir(locking_mode() == 'global')
+    if not lock:
+        raise RuntimeError('Could not lock the state dir')
+
+    database = open_database(os.path.expanduser(settings['state_dir']),
+                             settings['state_backend'])
+
+    reload_requested = []
+    def request_reload(signum, frame):
+        reload_requested.append(signum)
+    signal.signal(signal.SIGHUP, request_reload)
+
+    def when(url):
+        return feed_due(database, url)
+
+    load_render_cache()
+    scheduler = Scheduler()
+    scheduler.update(settings.feeds(), when)
+
+    def reschedule(urls):
+        now = time.time()
+        for url in urls:
+            # feeds that could not be polled at all would otherwise
+            # come up again right away
+            try:
+                scheduler.schedule(url, max(when(url), now + parse_duration(
+                    settings.get(url, 'min_interval'))))
+            except Exception:
+                log.exception('Could not schedule feed %s' % url)
+                scheduler.schedule(url, now + daemon_retry_interval)
+
+    while True:
+        due = []
+        try:
+            if reload_requested:
+                del reload_requested[:]
+                log.info('Reloading configuration')
+                try:
+                    settings.reload(check_settings)
+                except (ConfigParser.Error, ValueError) as e:
+                    log.error('Keeping the old configuration: %s' % str(e))
+                scheduler.update(settings.feeds(), when)
+
+            due = scheduler.pop_due(time.time())
+            if due:
+                run(database, due, make_leases())
+                save_render_cache()
+
+            expire(database, lock)
+        except Exception:
+            # a broken feed or a busy database must not end the daemon,
+            # the feeds of the pass are tried again later
+            log.exception('Polling %i feeds failed' % len(due))
+        reschedule(due)
+
+        # a signal cuts the sleep short
+        next_due = scheduler.next_due()
+        if next_due is None:
+            time.sleep(60)
+        elif next_due > time.time():
+            time.sleep(next_due - time.time())
@@ -20,19 +20,24 @@
 
 import sys
 import os
+import time
 import errno
 import random
 import socket
+import zlib
 import string
 import urllib
 import httplib
 import logging
+import threading
 
 if sys.version_info[0] == 2 and sys.version_info[1] >= 6:
     import hashlib as md5
 else:
     import md5
 
+hostname = socket.gethostname()
+
 def mkdir_p(path):
     try:
         os.makedirs(path)
@@ -47,9 +52,382 @@ def make_maildir(path):
                     for subdir in ('cur', 'tmp', 'new')):
         mkdir_p(dirname)
 
-def open_url(method, url, max_redirects = 3, redirect_on_status = (301, 302, 303, 307)):
+def timed_create_connection(timings, address, timeout = socket._GLOBAL_DEFAULT_TIMEOUT,
+                            source_address = None):
+    '''
+    socket.create_connection, but recording how long resolving the host
+    name and connecting took in timings.
+    '''
+
+    start = time.time()
+    addresses = socket.getaddrinfo(address[0], address[1], 0, socket.SOCK_STREAM)
+    timings['dns'] = time.time() - start
+
+    start = time.time()
+    error = socket.error('getaddrinfo returned no addresses')
+    for family, socktype, proto, canonname, sockaddr in addresses:
+        sock = socket.socket(family, socktype, proto)
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            timings['connect'] = time.time() - start
+            return sock
+        except socket.error as e:
+            error = e
+            sock.close()
+    raise error
+
+class DeadlineReached(socket.timeout):
+    '''
+    Raised when a request runs past its deadline.
+    '''
+
+def time_left(timeout, deadline):
+    '''
+    timeout, shortened so that it ends at deadline. Raises
+    DeadlineReached once the deadline has passed.
+    '''
+
+    if deadline is None:
+        return timeout
+    left = deadline - time.time()
+    if left <= 0:
+        raise DeadlineReached('deadline reached')
+    if timeout is None:
+        return left
+    return min(timeout, left)
+
+def timed_out(error):
+    # ssl reports timeouts as SSLError
+    return isinstance(error, socket.timeout) or 'timed out' in str(error)
+
+class DeadlineSocket(object):
+    '''
+    DeadlineSocket wraps the socket of a connection so that no read
+    waits longer than the read_timeout of the connection or past its
+    deadline. httplib reads a body by calling recv until it has as much
+    as it asked for, so a server sending a byte at a time could keep it
+    reading for as long as it likes otherwise.
+    '''
+
+    def __init__(self, sock, conn):
+        self.sock = sock
+        self.conn = conn
+
+    def recv(self, *args):
+        timeout = time_left(self.conn.read_timeout, self.conn.deadline)
+        self.sock.settimeout(timeout)
+        try:
+            return self.sock.recv(*args)
+        except socket.error as e:
+            # timeouts can end a little early, the clock cannot tell
+            if timeout != self.conn.read_timeout and timed_out(e):
+                raise DeadlineReached('deadline reached')
+            raise
+
+    def makefile(self, *args):
+        # the file keeps the socket open once httplib closes the
+        # connection, so it has to be made by the socket itself
+        handle = self.sock.makefile(*args)
+        handle._sock = DeadlineSocket(handle._sock, self.conn)
+        return handle
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+class TimedHTTPConnection(httplib.HTTPConnection):
+    '''
+    A HTTPConnection that records how long its last connect took in
+    timings. timeout only applies to connecting, once connected reads
+    time out after read_timeout seconds. Neither waits past deadline,
+    which is set for each request.
+    '''
+
+    def __init__(self, host, port, timeout = None, read_timeout = None):
+        httplib.HTTPConnection.__init__(self, host, port, timeout = timeout)
+        self.connect_timeout = timeout
+        self.read_timeout = read_timeout
+        self.deadline = None
+        self.timings = {}
+        self._create_connection = self.create_connection
+
+    def create_connection(self, *args):
+        return timed_create_connection(self.timings, *args)
+
+    def connect(self):
+        self.timeout = time_left(self.connect_timeout, self.deadline)
+        try:
+            httplib.HTTPConnection.connect(self)
+        except socket.error as e:
+            if self.timeout != self.connect_timeout and timed_out(e):
+                raise DeadlineReached('deadline reached')
+            raise
+        self.sock.settimeout(self.read_timeout)
+        self.sock = DeadlineSocket(self.sock, self)
+
+class TimedHTTPSConnection(httplib.HTTPSConnection):
+    '''
+    A HTTPSConnection that records how long its last connect and tls
+    handshake took in timings. timeout applies to connecting and the
+    handshake, once connected reads time out after read_timeout seconds.
+    Neither waits past deadline, which is set for each request.
+    '''
+
+    def __init__(self, host, port, timeout = None, read_timeout = None):
+        httplib.HTTPSConnection.__init__(self, host, port, timeout = timeout)
+        self.connect_timeout = timeout
+        self.read_timeout = read_timeout
+        self.deadline = None
+        self.timings = {}
+        self._create_connection = self.create_connection
+
+    def create_connection(self, *args):
+        return timed_create_connection(self.timings, *args)
+
+    def connect(self):
+        start = time.time()
+        self.timeout = time_left(self.connect_timeout, self.deadline)
+        try:
+            httplib.HTTPSConnection.connect(self)
+        except socket.error as e:
+            if self.timeout != self.connect_timeout and timed_out(e):
+                raise DeadlineReached('deadline reached')
+            raise
+        self.timings['tls'] = (time.time() - start -
+                               self.timings.get('dns', 0) - self.timings.get('connect', 0))
+        self.sock.settimeout(self.read_timeout)
+        self.sock = DeadlineSocket(self.sock, self)
+
+class ConnectionPool(object):
+    '''
+    ConnectionPool keeps persistent http connections around, keyed by
+    (scheme, host, port), so that requests to the same server reuse
+    them instead of doing a new tcp and tls handshake every time.
+
+    New connections give up connecting after connect_timeout seconds,
+    and a read that takes longer than read_timeout fails, so a server
+    that stops answering cannot hang a run.
+
+    With request_rate, connections to the same host are handed out at
+    most that many times per second, so fetching many feeds from one
+    server concurrently does not hammer it. A max_per_host or
+    request_rate of 0 means no limit.
+    '''
+
+    def __init__(self, max_per_host = 2, idle_timeout = 30,
+                 connect_timeout = 30, read_timeout = 60, request_rate = 0):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.request_rate = request_rate
+        self.idle = {}
+        self.active = {}
+        self.next_request = {}
+        self.condition = threading.Condition()
+
+    def acquire(self, key):
+        host = key[1]
+        with self.condition:
+            while True:
+                self.evict()
+                delay = self.next_request.get(host, 0) - time.time()
+                if delay > 0:
+                    self.condition.wait(min(delay, 1))
+                    continue
+                if self.idle.get(key):
+                    conn = self.idle[key].pop()[1]
+                    reused = True
+                    break
+                if not self.max_per_host or self.active.get(key, 0) < self.max_per_host:
+                    conn = self.connect(*key)
+                    reused = False
+                    break
+                # wait with a timeout, otherwise ^C is not delivered
+                self.condition.wait(1)
+
+            self.active[key] = self.active.get(key, 0) + 1
+            if self.request_rate:
+                self.next_request[host] = time.time() + 1.0 / self.request_rate
+            return conn, reused
+
+    def release(self, key, conn, reusable = True):
+        with self.condition:
+            self.active[key] = self.active[key] - 1
+            if reusable:
+                self.idle.setdefault(key, []).append((time.time(), conn))
+            else:
+                conn.close()
+            self.condition.notify_all()
+
+    def evict(self):
+        deadline = time.time() - self.idle_timeout
+        for key, connections in self.idle.items():
+            for last_used, conn in connections:
+                if last_used < deadline:
+                    conn.close()
+            self.idle[key] = [(last_used, conn) for last_used, conn in connections
+                              if last_used >= deadline]
+
+    def close_all(self):
+        with self.condition:
+            for connections in self.idle.values():
+                for last_used, conn in connections:
+                    conn.close()
+            self.idle = {}
+
+    def connect(self, scheme, host, port):
+        if scheme == "http":
+            return TimedHTTPConnection(host, port, self.connect_timeout, self.read_timeout)
+        else:
+            return TimedHTTPSConnection(host, port, self.connect_timeout, self.read_timeout)
+
+connection_pool = ConnectionPool()
+
+class Decoder(object):
+    '''
+    Decoder incrementally decompresses a gzip or deflate encoded body.
+    '''
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.decompressor = zlib.decompressobj()
+        self.started = False
+
+    def decompress(self, data):
+        if not self.started and data:
+            self.started = True
+            try:
+                return self.decompressor.decompress(data)
+            except zlib.error:
+                if self.encoding == 'gzip':
+                    raise
+                # some servers send raw deflate data without the zlib
+                # header
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        return self.decompressor.decompress(data)
+
+    def flush(self):
+        return self.decompressor.flush()
+
+class Response(object):
+    '''
+    Response wraps a httplib response, transparently decodes gzip and
+    deflate bodies and hands its connection back to the pool once the
+    body has been read completely or it is closed.
+
+    timings holds the seconds spent on the stages of the request,
+    including any redirects that led to it: dns, connect and tls for new
+    connections, first_byte until the response headers arrived and body
+    for reading the body.
+    '''
+
+    chunk_size = 16384
+
+    def __init__(self, key, conn, response, timings = None):
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+        self.timings = timings if timings is not None else {}
+        self.timings.setdefault('body', 0)
+
+        encoding = (response.getheader('content-encoding') or '').strip().lower()
+        if encoding in ('gzip', 'x-gzip', 'deflate'):
+            self.decoder = Decoder('deflate' if encoding == 'deflate' else 'gzip')
+        else:
+            self.decoder = None
+
+    def getheaders(self):
+        return self.response.getheaders()
+
+    def getheader(self, name, default = None):
+        return self.response.getheader(name, default)
+
+    def read(self, amt = None):
+        if amt is None:
+            chunks = []
+            while True:
+                chunk = self.read(self.chunk_size)
+                if not chunk:
+                    return ''.join(chunks)
+                chunks.append(chunk)
+
+        while True:
+            data = self.read_raw(amt)
+            if not self.decoder:
+                self.bytes_decoded += len(data)
+                return data
+
+            if data:
+                data = self.decoder.decompress(data)
+            else:
+                data = self.decoder.flush()
+            self.bytes_decoded += len(data)
+
+            # a chunk of compressed data does not necessarily decode to
+            # anything, only return an empty string at the end
+            if data or self.response.isclosed():
+                return data
+
+    def read_raw(self, amt):
+        start = time.time()
+        try:
+            data = self.response.read(amt)
+        except:
+            self.close()
+            raise
+        finally:
+            self.timings['body'] += time.time() - start
+
+        self.bytes_received += len(data)
+        if self.response.isclosed():
+            self.release(not self.response.will_close)
+        return data
+
+    def close(self):
+        # a connection can only be reused if the body has been consumed
+        self.release(self.response.isclosed() and not self.response.will_close)
+
+    def release(self, reusable):
+        if self.conn:
+            connection_pool.release(self.key, self.conn, reusable)
+            self.conn = None
+
+class FetchError(Exception):
+    '''
+    Raised by open_url if the request failed, with the headers of the
+    response if there was one.
+    '''
+
+    def __init__(self, message, headers = None):
+        Exception.__init__(self, message)
+        self.headers = headers or []
+
+def open_url(method, url, headers = None, max_redirects = 3,
+             redirect_on_status = (301, 302, 303, 307), deadline = None):
+    '''
+    Send a request and return the Response, following redirects. No
+    part of the request, including reading the body of the response,
+    waits past deadline, DeadlineReached is raised instead.
+    '''
+
     log = logging.getLogger('%s %s' % (method, url))
 
+    headers = dict(headers or {})
+    headers.setdefault('Accept-Encoding', 'gzip, deflate')
+
+    timings = {}
     redirectcount = 0
     while redirectcount < max_redirects:
         (type_, rest) = urllib.splittype(url)
@@ -62,32 +440,106 @@ def open_url(method, url, max_redirects = 3, redirect_on_status = (301, 302, 303
         elif port == None:
             port = 80
 
-        try:
-            if type_ == "http":
-                conn = httplib.HTTPConnection("%s:%s" %(host, port))
-            else:
-                conn = httplib.HTTPSConnection("%s:%s" %(host, port))
-            conn.request(method, path)
-        except (httplib.HTTPException, socket.error) as e:
-            log.warning('http request failed: %s' % str(e))
-            return None
+        key = (type_, host, int(port))
+        while True:
+            conn, reused = connection_pool.acquire(key)
+            conn.timings = {}
+            conn.deadline = deadline
+            try:
+                start = time.time()
+                conn.request(method, path, headers = headers)
+                raw_response = conn.getresponse()
+                elapsed = time.time() - start
+                for name, seconds in conn.timings.items():
+                    timings[name] = timings.get(name, 0) + seconds
+                    elapsed -= seconds
+                timings['first_byte'] = timings.get('first_byte', 0) + elapsed
+                response = Response(key, conn, raw_response, timings)
+                break
+            except (httplib.HTTPException, socket.error) as e:
+                connection_pool.release(key, conn, False)
+                if isinstance(e, DeadlineReached):
+                    raise
+                if reused:
+                    # the server closed the idle connection, try again
+                    # with a fresh one
+                    log.debug('persistent connection dropped: %s' % str(e))
+                    continue
+                raise FetchError('http request failed: %s' % str(e))
 
-        response = conn.getresponse()
         if response.status == 200:
             return response
+
+        # drain the body so that the connection can be reused
+        try:
+            response.read()
+        except (httplib.HTTPException, socket.error, zlib.error) as e:
+            pass
+
+        if response.status == 304:
+            # the conditional request matched, the caller can tell from
+            # the status that there is nothing new
+            log.info('Not modified')
+            return response
         elif response.status in redirect_on_status:
-            headers = response.getheaders()
-            for header in headers:
+            for header in response.getheaders():
                 if header[0] == "location":
                     url = header[1]
         else:
-            log.warning('Received unexpected status: %i %s' % (response.status, response.reason))
-            return None
+            raise FetchError('received unexpected status: %i %s' %
+                             (response.status, response.reason),
+                             response.getheaders())
 
         redirectcount = redirectcount + 1
 
-    log.warning('Maximum number of redirections reached')
-    return None
+    raise FetchError('maximum number of redirections reached')
+
+durations = {
+    's': 1, 'sec': 1, 'second': 1, 'seconds': 1,
+    'm': 60, 'min': 60, 'minute': 60, 'minutes': 60,
+    'h': 3600, 'hour': 3600, 'hours': 3600,
+    'd': 86400, 'day': 86400, 'days': 86400,
+    'w': 604800, 'week': 604800, 'weeks': 604800,
+}
+
+def parse_quantity(value, units, what):
+    '''
+    Parse a number followed by one of the units, a plain number is taken
+    as it is. what names the kind of quantity in the error.
+    '''
+
+    parts = value.split()
+    try:
+        if len(parts) == 1:
+            return int(parts[0])
+        elif len(parts) == 2:
+            return int(parts[0]) * units[parts[1].lower()]
+    except (ValueError, KeyError) as e:
+        pass
+
+    raise ValueError('Invalid %s %r' % (what, value))
+
+def parse_duration(value):
+    '''
+    Parse durations like '5 days' or '90 min' to seconds, a plain number
+    is taken as seconds.
+    '''
+
+    return parse_quantity(value, durations, 'duration')
+
+sizes = {
+    'b': 1, 'byte': 1, 'bytes': 1,
+    'k': 1024, 'kb': 1024, 'kib': 1024,
+    'm': 1024 ** 2, 'mb': 1024 ** 2, 'mib': 1024 ** 2,
+    'g': 1024 ** 3, 'gb': 1024 ** 3, 'gib': 1024 ** 3,
+}
+
+def parse_size(value):
+    '''
+    Parse sizes like '50 MB' to bytes, a plain number is taken as bytes.
+    '''
+
+    return parse_quantity(value, sizes, 'size')
 
 def generate_random_string(length,
                            character_set = string.ascii_letters + string.digits):
@@ -0,0 +1,369 @@
+#!/usr/bin/python
+
+# Runs rss2maildir against synthetic feeds served from a local http
+# server and reports feeds/s, items/s, bytes written and the time spent
+# in each stage. Results can be written to a JSON file and compared to
+# the results of an earlier commit with --compare.
+
+import sys
+import os
+import time
+import gzip
+import json
+import random
+import shutil
+import socket
+import tempfile
+import StringIO
+import threading
+import subprocess
+import email.utils
+import BaseHTTPServer
+import SocketServer
+from optparse import OptionParser
+
+basedir = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(basedir, '..', '..'))
+
+from rss2maildir.Settings import settings
+import rss2maildir.rss2maildir
+from rss2maildir.Database import Database
+from rss2maildir.Feed import Feed
+from rss2maildir.Maildir import Maildir
+
+words = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur',
+         'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor')
+
+class FeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    Serves /<n> as feed number n. Every feed has the newest options.items
+    of its items, generation decides how many new ones were added since
+    the first run.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, options):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FeedHandler)
+        self.options = options
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+
+    def count(self, status, length):
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += length
+            if status == 304:
+                self.not_modified += 1
+
+    def format(self, number):
+        if self.options.format == 'mixed':
+            return ('rss', 'atom')[number % 2]
+        return self.options.format
+
+    def item_body(self, feed, number):
+        rng = random.Random(feed * 100003 + number)
+        paragraphs = []
+        length = 0
+        while length < self.options.size:
+            paragraph = ' '.join(rng.choice(words) for n in range(60))
+            paragraphs.append('<p>%s <a href="http://example.org/%i">link</a></p>' %
+                              (paragraph, rng.randint(0, 1000)))
+            length += len(paragraphs[-1])
+        return ''.join(paragraphs)
+
+    def document(self, feed):
+        options = self.options
+        newest = options.items + self.generation * options.new_items
+        numbers = range(newest, max(newest - options.items, 0), -1)
+
+        entries = []
+        for number in numbers:
+            link = 'http://example.org/%i/%i' % (feed, number)
+            date = 1704067200 + number * 3600
+            body = self.item_body(feed, number).replace('&', '&amp;').replace('<', '&lt;')
+            if self.format(feed) == 'atom':
+                entries.append(
+                    '<entry><title>Item %i of feed %i</title><link href="%s"/>'
+                    '<id>%s</id><updated>%s</updated><author><name>Author %i</name></author>'
+                    '<content type="html">%s</content></entry>' %
+                    (number, feed, link, link,
+                     time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(date)),
+                     feed, body))
+            else:
+                entries.append(
+                    '<item><title>Item %i of feed %i</title><link>%s</link>'
+                    '<guid>%s</guid><pubDate>%s</pubDate><description>%s</description></item>' %
+                    (number, feed, link, link, email.utils.formatdate(date, usegmt = True),
+                     body))
+
+        if self.format(feed) == 'atom':
+            return ('<?xml version="1.0" encoding="utf-8"?>'
+                    '<feed xmlns="http://www.w3.org/2005/Atom"><title>Feed %i</title>'
+                    '<id>urn:feed:%i</id>%s</feed>' % (feed, feed, ''.join(entries)))
+        return ('<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel>'
+                '<title>Feed %i</title>%s</channel></rss>' % (feed, ''.join(entries)))
+
+class FeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, headers, body = ''):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+        self.server.count(status, len(body))
+
+    def do_GET(self):
+        server = self.server
+        options = server.options
+        if options.latency:
+            time.sleep(options.latency / 1000.0)
+
+        # the validators only change when the feed does
+        feed = int(self.path.strip('/'))
+        version = server.generation * options.new_items
+        etag = '"%i-%i"' % (feed, version)
+        last_modified = email.utils.formatdate(1704067200 + version * 3600, usegmt = True)
+
+        headers = [('Content-Type', 'application/%s+xml' % server.format(feed))]
+        not_modified = []
+        if options.validators in ('etag', 'both'):
+            headers.append(('ETag', etag))
+            not_modified.append(self.headers.get('If-None-Match') == etag)
+        if options.validators in ('last-modified', 'both'):
+            headers.append(('Last-Modified', last_modified))
+            not_modified.append(self.headers.get('If-Modified-Since') == last_modified)
+        if not_modified and all(not_modified):
+            return self.respond(304, headers)
+
+        body = server.document(feed)
+        if options.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO.StringIO()
+            compressed = gzip.GzipFile(fileobj = buf, mode = 'wb')
+            compressed.write(body)
+            compressed.close()
+            body = buf.getvalue()
+            headers.append(('Content-Encoding', 'gzip'))
+        self.respond(200, headers, body)
+
+class StageTimer(object):
+    '''
+    Adds up the time spent in the stages of a run by wrapping the
+    functions that make them up. Fetching happens in several threads at
+    once, so the fetch time can be larger than the time of the run.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+
+    def add(self, stage, start):
+        with self.lock:
+            self.times[stage] = self.times.get(stage, 0) + time.time() - start
+
+    def reset(self):
+        with self.lock:
+            self.times = {}
+
+    def wrap(self, owner, name, stage):
+        function = getattr(owner, name)
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(stage, start)
+        setattr(owner, name, timed)
+
+    def wrap_generator(self, owner, name, stage):
+        function = getattr(owner, name)
+        def timed(*args, **kwargs):
+            iterator = function(*args, **kwargs)
+            while True:
+                start = time.time()
+                try:
+                    value = next(iterator)
+                finally:
+                    self.add(stage, start)
+                yield value
+        setattr(owner, name, timed)
+
+def directory_size(path):
+    size = 0
+    files = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(dirpath, filename))
+            files += 1
+    return files, size
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd = basedir, stderr = open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError) as e:
+        return None
+
+def write_config(path, tmpdir, port, options):
+    general = {
+        'state_dir': os.path.join(tmpdir, 'state'),
+        'maildir_root': os.path.join(tmpdir, 'mail'),
+        # every feed is served by the same host
+        'host_request_rate': '0',
+    }
+    common = {
+        'interval': '0',
+        'min_interval': '0',
+    }
+    for setting in options.settings:
+        key, _, value = setting.partition('=')
+        section, _, key = key.rpartition('.')
+        (common if section == 'common' else general)[key.strip()] = value.strip()
+
+    with open(path, 'w') as handle:
+        for name, section in (('general', general), ('common', common)):
+            handle.write('[%s]\n' % name)
+            for key, value in sorted(section.items()):
+                handle.write('%s = %s\n' % (key, value))
+        for feed in range(options.feeds):
+            handle.write('[http://127.0.0.1:%i/%i]\nname = feed%i\n' % (port, feed, feed))
+
+def run_benchmark(options):
+    server = FeedServer(options)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    tmpdir = tempfile.mkdtemp(prefix = 'rss2maildir-benchmark-')
+    config = os.path.join(tmpdir, 'config')
+    write_config(config, tmpdir, server.server_address[1], options)
+    settings.read(config)
+
+    timer = StageTimer()
+    timer.wrap(Feed, 'fetch', 'fetch')
+    timer.wrap_generator(Feed, 'feed_items', 'parse')
+    timer.wrap(Database, 'seen_before', 'state')
+    timer.wrap(Database, 'mark_seen', 'state')
+    timer.wrap(Feed, 'commit', 'state')
+    timer.wrap(Maildir, 'add', 'deliver')
+    timer.wrap(Maildir, 'flush', 'deliver')
+    # the render workers look render_message up by name, so it can only
+    # be timed when the main process renders
+    if settings.getint(settings.general_section_name, 'render_workers') <= 1:
+        timer.wrap(rss2maildir.rss2maildir, 'render_message', 'render')
+
+    results = []
+    try:
+        for run in range(options.runs):
+            server.generation = run
+            server.requests = server.not_modified = server.bytes_sent = 0
+            timer.reset()
+            files, size = directory_size(os.path.join(tmpdir, 'mail'))
+
+            start = time.time()
+            rss2maildir.rss2maildir.main()
+            seconds = time.time() - start
+
+            new_files, new_size = directory_size(os.path.join(tmpdir, 'mail'))
+            results.append({
+                'run': run,
+                'seconds': seconds,
+                'feeds': options.feeds,
+                'items': new_files - files,
+                'requests': server.requests,
+                'not_modified': server.not_modified,
+                'bytes_served': server.bytes_sent,
+                'bytes_written': new_size - size,
+                'state_bytes': directory_size(os.path.join(tmpdir, 'state'))[1],
+                'feeds_per_second': options.feeds / seconds,
+                'items_per_second': (new_files - files) / seconds,
+                'stages': dict(timer.times),
+            })
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmpdir)
+
+    return results
+
+def report(results, previous = None):
+    print '%4s %8s %7s %8s %5s %10s %10s %12s  %s' % (
+        'run', 'seconds', 'items', 'requests', '304', 'feeds/s', 'items/s', 'written', 'stages')
+    for result in results:
+        stages = ' '.join('%s=%.2fs' % item for item in sorted(result['stages'].items()))
+        print '%4i %8.2f %7i %8i %5i %10.1f %10.1f %12i  %s' % (
+            result['run'], result['seconds'], result['items'], result['requests'],
+            result['not_modified'], result['feeds_per_second'], result['items_per_second'],
+            result['bytes_written'], stages)
+
+    if previous:
+        print
+        print 'compared to %s:' % (previous.get('commit') or 'previous results')
+        for result, old in zip(results, previous['results']):
+            print '%4i %+7.1f%% seconds' % (
+                result['run'], (result['seconds'] / old['seconds'] - 1) * 100),
+            for stage, seconds in sorted(result['stages'].items()):
+                if old['stages'].get(stage):
+                    print ' %s %+.1f%%' % (stage, (seconds / old['stages'][stage] - 1) * 100),
+            print
+
+def main():
+    oparser = OptionParser()
+    oparser.add_option('-f', '--feeds', dest = 'feeds', type = 'int', default = 20,
+                       help = 'number of feeds')
+    oparser.add_option('-i', '--items', dest = 'items', type = 'int', default = 50,
+                       help = 'number of items in each feed')
+    oparser.add_option('-n', '--new-items', dest = 'new_items', type = 'int', default = 5,
+                       help = 'number of items added to each feed between runs')
+    oparser.add_option('-r', '--runs', dest = 'runs', type = 'int', default = 3,
+                       help = 'number of runs, the first one delivers everything')
+    oparser.add_option('-s', '--size', dest = 'size', type = 'int', default = 2000,
+                       help = 'size of the html body of each item in bytes')
+    oparser.add_option('--format', dest = 'format', default = 'rss',
+                       choices = ('rss', 'atom', 'mixed'),
+                       help = 'rss, atom or mixed')
+    oparser.add_option('--validators', dest = 'validators', default = 'both',
+                       choices = ('none', 'etag', 'last-modified', 'both'),
+                       help = 'which of ETag and Last-Modified the server sends')
+    oparser.add_option('--latency', dest = 'latency', type = 'int', default = 0,
+                       help = 'milliseconds the server waits before answering')
+    oparser.add_option('--gzip', dest = 'gzip', action = 'store_true', default = False,
+                       help = 'compress responses if the client accepts gzip')
+    oparser.add_option('--set', dest = 'settings', action = 'append', default = [],
+                       help = 'rss2maildir setting as key=value, common.key=value for the common section')
+    oparser.add_option('-o', '--output', dest = 'output',
+                       help = 'write the results to this JSON file')
+    oparser.add_option('--compare', dest = 'compare',
+                       help = 'compare with results written by an earlier --output')
+    options, args = oparser.parse_args()
+
+    results = run_benchmark(options)
+
+    previous = None
+    if options.compare:
+        previous = json.load(open(options.compare))
+    report(results, previous)
+
+    if options.output:
+        with open(options.output, 'w') as handle:
+            json.dump({
+                'commit': git_commit(),
+                'time': time.time(),
+                'host': socket.gethostname(),
+                'options': options.__dict__,
+                'results': results,
+            }, handle, indent = 2, sort_keys = True)
+
+if __name__ == '__main__':
+    main()
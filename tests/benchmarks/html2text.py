@@ -0,0 +1,87 @@
+#!/usr/bin/python
+
+# Times HTML2Text on the documents in tests/html and on large synthetic
+# documents, e.g. full-content Atom entries.
+
+import sys
+import os
+import glob
+import time
+import random
+from optparse import OptionParser
+
+basedir = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(basedir, '..', '..'))
+
+from rss2maildir.HTML2Text import HTML2Text
+
+words = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur',
+         'adipiscing', 'elit', '&amp;', '&mdash;', '&#8220;quoted&#8221;')
+
+def paragraph(rng, links = True, length = None):
+    text = []
+    for n in range(length or rng.randint(20, 120)):
+        if links and rng.random() < 0.05:
+            text.append('<a href="http://example.org/%i">%s</a>' %
+                        (rng.randint(0, 1000), rng.choice(words)))
+        else:
+            text.append(rng.choice(words))
+    return ' '.join(text)
+
+def synthetic_document(size, seed = 0):
+    rng = random.Random(seed)
+    blocks = []
+    length = 0
+    while length < size:
+        kind = rng.random()
+        if kind < 0.6:
+            block = '<p>%s</p>' % paragraph(rng)
+        elif kind < 0.75:
+            block = '<ul>%s</ul>' % ''.join('<li>%s</li>' % paragraph(rng, False)
+                                            for n in range(rng.randint(2, 8)))
+        elif kind < 0.85:
+            block = '<blockquote>%s</blockquote>' % paragraph(rng)
+        elif kind < 0.92:
+            block = '<h2>%s</h2>' % paragraph(rng, False, 8)
+        else:
+            block = '<pre>%s</pre>' % '\n'.join(paragraph(rng, False, 10)
+                                                for n in range(5))
+        blocks.append(block)
+        length += len(block)
+    return '\n'.join(blocks)
+
+def measure(document, repeat):
+    best = None
+    for n in range(repeat):
+        start = time.time()
+        parser = HTML2Text()
+        parser.feed(document)
+        parser.gettext()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    oparser = OptionParser()
+    oparser.add_option('-r', '--repeat', dest = 'repeat', type = 'int', default = 5,
+                       help = 'number of runs per document, the best one is reported')
+    oparser.add_option('-s', '--sizes', dest = 'sizes', default = '10,50,200,1000',
+                       help = 'comma separated sizes of the synthetic documents in KB')
+    options, args = oparser.parse_args()
+
+    corpus = sorted(glob.glob(os.path.join(basedir, '..', 'html', '*.html')))
+    total = 0
+    for filename in corpus:
+        total += measure(open(filename).read(), options.repeat)
+    print '%-30s %10.2f ms' % ('tests/html (%i files)' % len(corpus), total * 1000)
+
+    for size in [int(size) for size in options.sizes.split(',')]:
+        document = synthetic_document(size * 1024)
+        elapsed = measure(document, options.repeat)
+        print '%-30s %10.2f ms %10.2f MB/s' % (
+            'synthetic %i KB' % size, elapsed * 1000,
+            len(document) / elapsed / 1024 / 1024)
+
+if __name__ == '__main__':
+    main()
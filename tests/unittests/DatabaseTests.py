@@ -0,0 +1,155 @@
+import os
+import time
+import shutil
+import hashlib
+import marshal
+import tempfile
+import unittest
+
+from rss2maildir.Database import SeenRecord, SeenIndex, DbmDatabase, \
+    SQLiteDatabase, migrate_dbm_to_sqlite
+
+class SeenRecordTest(unittest.TestCase):
+    digest = '\x01' * 8 + '\xff' * 8
+
+    def test_roundtrip(self):
+        record = SeenRecord(self.digest, 1199145600, u'<a@b> <c@d>')
+        packed = record.pack()
+        self.assertEqual(len(packed), SeenRecord.layout.size + len('<a@b> <c@d>'))
+
+        record = SeenRecord.unpack(packed)
+        self.assertEqual(record.digest, self.digest)
+        self.assertEqual(record.created, 1199145600)
+        self.assertEqual(record.message_id, u'<a@b> <c@d>')
+
+    def test_marshalled_record(self):
+        record = SeenRecord.unpack(marshal.dumps({
+            'message-id': '<a@b>',
+            'created': 'Tue,  1 Jan 2008 00:00:00 -0000',
+            'contentmd5': self.digest.encode('hex'),
+        }))
+        self.assertEqual(record.digest, self.digest)
+        self.assertEqual(record.created, 1199145600)
+        self.assertEqual(record.message_id, '<a@b>')
+
+        # records are rewritten in the binary layout
+        self.assertEqual(SeenRecord.unpack(record.pack()).created, 1199145600)
+
+class SeenIndexTest(unittest.TestCase):
+    def test_lookup(self):
+        pairs = dict((u'http://example.org/%i' % n, os.urandom(16))
+                     for n in range(1000))
+        index = SeenIndex(SeenIndex.from_pairs(pairs.items()).pack())
+
+        for key, digest in pairs.items():
+            self.assertEqual(index.get(key), digest)
+        self.assertEqual(index.get(u'http://example.org/new'), None)
+
+    def test_changes(self):
+        index = SeenIndex.from_pairs([(u'a', '1' * 16), (u'b', '2' * 16)])
+        index.set(u'c', '3' * 16)
+        index.discard(u'a')
+
+        index = SeenIndex(index.pack())
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.get(u'a'), None)
+        self.assertEqual(index.get(u'c'), '3' * 16)
+
+class FakeFeed(object):
+    def __init__(self, url):
+        self.url = url
+
+class FakeItem(object):
+    def __init__(self, feed, link, content, guid = None, created = None):
+        self.feed = feed
+        self.link = link
+        self.guid = guid
+        self.md5sum = hashlib.md5(content).hexdigest()
+        self.created = created or int(time.time())
+        self.message_id = '<%s@localhost>' % hashlib.md5(link + content).hexdigest()
+        self.previous_message_id = None
+
+class MigrationTest(unittest.TestCase):
+    feed = FakeFeed('http://example.org/feed')
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def item(self, n, content = None):
+        return FakeItem(self.feed, u'http://example.org/%i' % n,
+                        content or 'content %i' % n,
+                        guid = u'id-%i' % n if n % 2 else None)
+
+    def test_roundtrip(self):
+        source = DbmDatabase(self.path)
+        items = [self.item(n) for n in range(3)]
+        for item in items:
+            source.mark_seen(item)
+        source.set_feed_metadata(self.feed.url, {'polled': 1, 'etag': '"x"'})
+        source.close()
+
+        # one record per link, and one for the guid of item 1
+        self.assertEqual(migrate_dbm_to_sqlite(self.path), 4)
+
+        target = SQLiteDatabase(self.path)
+        try:
+            self.assertEqual(target.get_feed_metadata(self.feed.url),
+                             {'polled': 1, 'etag': '"x"'})
+            for n in range(3):
+                self.assertTrue(target.seen_before(self.item(n)))
+
+            changed = self.item(0, 'changed')
+            self.assertFalse(target.seen_before(changed))
+            self.assertEqual(changed.previous_message_id, items[0].message_id)
+            self.assertFalse(target.seen_before(self.item(3)))
+        finally:
+            target.close()
+
+class PruneTest(unittest.TestCase):
+    feed = FakeFeed('http://example.org/feed')
+    old = int(time.time()) - 100 * 86400
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.database = SQLiteDatabase(self.path)
+
+    def tearDown(self):
+        self.database.close()
+        shutil.rmtree(self.path)
+
+    def mark_seen(self, *links):
+        items = [FakeItem(self.feed, link, 'content', created = self.old)
+                 for link in links]
+        for item in items:
+            self.database.mark_seen(item)
+        self.database.commit()
+        return items
+
+    def test_items_gone_from_the_feed(self):
+        self.mark_seen(u'http://example.org/1', u'http://example.org/2')
+        self.database.set_feed_metadata(self.feed.url,
+                                        {'current': [u'http://example.org/2']})
+
+        self.assertEqual(self.database.prune(30 * 86400), 1)
+        self.assertEqual(self.database.get_seen(self.feed.url, u'http://example.org/1'), None)
+        self.assertTrue(self.database.get_seen(self.feed.url, u'http://example.org/2'))
+
+    def test_feed_without_current(self):
+        # e.g. a feed that has only answered 304 since the upgrade
+        items = self.mark_seen(u'http://example.org/1', u'http://example.org/2')
+        self.database.set_feed_metadata(self.feed.url, {'polled': 1})
+
+        self.assertEqual(self.database.prune(30 * 86400), 0)
+        for item in items:
+            self.assertTrue(self.database.seen_before(item))
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SeenRecordTest))
+    suite.addTest(unittest.makeSuite(SeenIndexTest))
+    suite.addTest(unittest.makeSuite(MigrationTest))
+    suite.addTest(unittest.makeSuite(PruneTest))
+    return suite
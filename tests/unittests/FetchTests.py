@@ -0,0 +1,99 @@
+import time
+import socket
+import unittest
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from rss2maildir.Feed import Feed
+from rss2maildir.utils import connection_pool, open_url
+
+class DripHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Sends /body a byte of its body at a time and /headers a byte of the
+    response headers at a time.
+    '''
+
+    interval = 0.05
+
+    def drip(self, data):
+        for byte in data:
+            self.wfile.write(byte)
+            self.wfile.flush()
+            time.sleep(self.interval)
+
+    def do_GET(self):
+        body = '<rss version="2.0"><channel></channel></rss>' * 100
+        headers = ('HTTP/1.0 200 OK\r\nContent-Length: %i\r\n\r\n' % len(body))
+        try:
+            if self.path == '/headers':
+                self.drip(headers)
+            else:
+                self.wfile.write(headers)
+            self.drip(body)
+        except socket.error:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+class DripServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # the client hanging up on purpose is expected
+        pass
+
+class FakeDatabase(object):
+    def get_feed_metadata(self, url):
+        raise KeyError(url)
+
+class DeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.server = DripServer(('127.0.0.1', 0), DripHandler)
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%i' % self.server.server_address[1]
+
+        # every single byte arrives well within the read timeout
+        self.read_timeout = connection_pool.read_timeout
+        connection_pool.read_timeout = 1
+
+    def tearDown(self):
+        connection_pool.read_timeout = self.read_timeout
+        connection_pool.close_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_read_body(self):
+        start = time.time()
+        response = open_url('GET', self.url + '/body', deadline = start + 0.5)
+        self.assertRaises(socket.timeout, response.read, 16384)
+        response.close()
+        self.assertTrue(time.time() - start < 1)
+
+    def test_feed_is_deferred(self):
+        for path in ('/body', '/headers'):
+            start = time.time()
+            feed = Feed(FakeDatabase(), self.url + path, deadline = start + 0.5)
+            self.assertFalse(feed.fetch())
+            self.assertTrue(feed.deferred)
+            self.assertEqual(feed.error, None)
+            self.assertEqual(feed.body, None)
+            self.assertTrue(time.time() - start < 1)
+
+    def test_without_deadline(self):
+        DripHandler.interval = 0
+        try:
+            feed = Feed(FakeDatabase(), self.url + '/body')
+            self.assertTrue(feed.fetch())
+            self.assertFalse(feed.deferred)
+            feed.body.close()
+        finally:
+            DripHandler.interval = 0.05
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(DeadlineTest))
+    return suite
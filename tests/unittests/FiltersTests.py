@@ -0,0 +1,48 @@
+import time
+import unittest
+
+from rss2maildir.Filters import FilterRules
+
+class FakeItem(object):
+    def __init__(self, **fields):
+        self.title = u'A title'
+        self.author = u'someone@example.org'
+        self.link = u'http://example.org/item'
+        self.categories = []
+        self.created = time.time()
+        self.__dict__.update(fields)
+
+class FilterRulesTest(unittest.TestCase):
+    def test_no_rules(self):
+        rules = FilterRules('')
+        self.assertEqual(len(rules), 0)
+        self.assertTrue(rules.accept(FakeItem()))
+
+    def test_exclude(self):
+        rules = FilterRules('exclude title (?i)sponsored')
+        self.assertTrue(rules.accept(FakeItem()))
+        self.assertFalse(rules.accept(FakeItem(title = u'A Sponsored post')))
+
+    def test_include_categories(self):
+        rules = FilterRules('include categories ^python$')
+        self.assertFalse(rules.accept(FakeItem()))
+        self.assertFalse(rules.accept(FakeItem(categories = [u'pythonic'])))
+        self.assertTrue(rules.accept(FakeItem(categories = [u'web', u'python'])))
+
+    def test_all_rules_apply(self):
+        rules = FilterRules('include link ^http://example.org/\n'
+                            '# comments are skipped\n'
+                            'exclude age 1 day')
+        self.assertTrue(rules.accept(FakeItem()))
+        self.assertFalse(rules.accept(FakeItem(created = time.time() - 2 * 86400)))
+        self.assertFalse(rules.accept(FakeItem(link = u'http://example.com/')))
+
+    def test_invalid_rules(self):
+        self.assertRaises(ValueError, FilterRules, 'exclude body spam')
+        self.assertRaises(ValueError, FilterRules, 'exclude title (')
+        self.assertRaises(ValueError, FilterRules, 'exclude age soon')
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(FilterRulesTest))
+    return suite
@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from rss2maildir.Maildir import Maildir, FlushError
+from rss2maildir.utils import make_maildir
+
+class MaildirTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        make_maildir(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def listdir(self, subdir):
+        return os.listdir(os.path.join(self.path, subdir))
+
+    def messages(self):
+        return sorted(open(os.path.join(self.path, 'new', name)).read()
+                      for name in self.listdir('new'))
+
+    def deliver(self, fsync):
+        maildir = Maildir(self.path, fsync, batch_size = 2)
+        for number in range(3):
+            maildir.add('message %i' % number)
+            if maildir.batch_full():
+                maildir.flush()
+        maildir.flush()
+
+        self.assertEqual(self.listdir('tmp'), [])
+        self.assertEqual(self.messages(), ['message 0', 'message 1', 'message 2'])
+
+    def test_none(self):
+        self.deliver('none')
+
+    def test_batch(self):
+        self.deliver('batch')
+
+    def test_message(self):
+        self.deliver('message')
+
+    def test_batch_waits_for_flush(self):
+        maildir = Maildir(self.path, 'batch')
+        maildir.add('message')
+        self.assertEqual(len(self.listdir('tmp')), 1)
+        self.assertEqual(self.listdir('new'), [])
+        maildir.flush()
+        self.assertEqual(self.listdir('tmp'), [])
+        self.assertEqual(self.messages(), ['message'])
+
+    def test_unknown_mode(self):
+        self.assertRaises(RuntimeError, Maildir, self.path, 'always')
+
+    def test_failed_write(self):
+        for fsync in Maildir.modes:
+            maildir = Maildir(self.path, fsync)
+            # only byte strings can be written
+            self.assertRaises(UnicodeEncodeError, maildir.add, u'caf\u00e9')
+            maildir.flush()
+            self.assertEqual(self.listdir('tmp'), [])
+            self.assertEqual(self.listdir('new'), [])
+
+    def test_failed_rename(self):
+        shutil.rmtree(os.path.join(self.path, 'new'))
+        for fsync in ('none', 'message'):
+            maildir = Maildir(self.path, fsync)
+            self.assertRaises(OSError, maildir.add, 'message')
+            self.assertEqual(self.listdir('tmp'), [])
+
+    def test_failed_flush(self):
+        maildir = Maildir(self.path, 'batch')
+        maildir.add('message 0')
+        maildir.add('message 1')
+        shutil.rmtree(os.path.join(self.path, 'new'))
+        try:
+            maildir.flush()
+            self.fail('flush did not fail')
+        except FlushError as e:
+            self.assertEqual(e.moved, 0)
+        self.assertEqual(self.listdir('tmp'), [])
+
+    def test_flush_failing_halfway(self):
+        renamed = []
+        def rename(source, target):
+            if len(renamed) == 2:
+                raise OSError('rename failed')
+            original(source, target)
+            renamed.append(target)
+
+        maildir = Maildir(self.path, 'batch')
+        for number in range(4):
+            maildir.add('message %i' % number)
+        original, os.rename = os.rename, rename
+        try:
+            maildir.flush()
+            self.fail('flush did not fail')
+        except FlushError as e:
+            self.assertEqual(e.moved, 2)
+        finally:
+            os.rename = original
+        self.assertEqual(self.listdir('tmp'), [])
+        self.assertEqual(self.messages(), ['message 0', 'message 1'])
+
+    def test_failed_fsync(self):
+        def fsync(fd):
+            raise OSError('fsync failed')
+
+        maildir = Maildir(self.path, 'batch')
+        maildir.add('message 0')
+        maildir.add('message 1')
+        original, os.fsync = os.fsync, fsync
+        try:
+            self.assertRaises(OSError, maildir.flush)
+        finally:
+            os.fsync = original
+        self.assertEqual(self.listdir('tmp'), [])
+        self.assertEqual(self.listdir('new'), [])
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(MaildirTest))
+    return suite
@@ -0,0 +1,72 @@
+import email
+import unittest
+from email.header import decode_header, make_header
+
+from rss2maildir.Item import build_message, serialize_message
+
+class SerializeMessageTest(unittest.TestCase):
+    rundate = 'Mon,  1 Jan 2024 12:00:00 -0000'
+
+    def fields(self, **changes):
+        fields = {
+            'feed_url': 'http://example.org/feed.xml',
+            'author': u'Jane Doe',
+            'title': u'Hello',
+            'link': u'http://example.org/hello',
+            'content': u'<p>Hello <b>world</b></p>',
+            'message_id': '<202401011200.abcdef@localhost>',
+            'previous_message_id': None,
+            'createddate': 'Mon,  1 Jan 2024 10:00:00 -0000',
+            'textwidth': 70,
+            'include_html_part': False,
+        }
+        fields.update(changes)
+        return fields
+
+    def header(self, message, name):
+        value = make_header(decode_header(message[name]))
+        return u' '.join(unicode(value).split())
+
+    def assertEquivalent(self, fields, subject, text_content):
+        expected = email.message_from_string(
+            build_message(fields, subject, text_content, self.rundate).as_string())
+        data = serialize_message(fields, subject, text_content, self.rundate)
+        self.assertTrue(data)
+        message = email.message_from_string(data)
+
+        self.assertEqual(message.items()[0][0], 'Content-Type')
+        self.assertEqual(message.get_content_type(), 'multipart/alternative')
+        self.assertEqual(message.keys(), expected.keys())
+        for name in expected.keys():
+            if name != 'Content-Type':
+                self.assertEqual(self.header(message, name),
+                                 self.header(expected, name))
+
+        parts = message.get_payload()
+        expected_parts = expected.get_payload()
+        self.assertEqual(len(parts), len(expected_parts))
+        for part, expected_part in zip(parts, expected_parts):
+            self.assertEqual(part.items(), expected_part.items())
+            self.assertEqual(part.get_payload(decode = True),
+                             expected_part.get_payload(decode = True))
+
+    def test_ascii(self):
+        self.assertEquivalent(self.fields(), u'Hello', u'Hello world\n')
+
+    def test_non_ascii(self):
+        self.assertEquivalent(
+            self.fields(author = u'Jos\xe9 Mar\xeda', include_html_part = True,
+                        content = u'<p>\u201cquoted\u201d \u20ac</p>'),
+            u'Caf\xe9 \u2014 ' * 10, u'\u201cquoted\u201d \u20ac\n')
+
+    def test_long_subject_and_references(self):
+        self.assertEquivalent(
+            self.fields(previous_message_id = '<a@localhost> <b@localhost>'),
+            u'A fairly long subject that HTML2Text has wrapped at seventy\n'
+            u'characters, which the headers have to fold again',
+            u'Hello world\n' * 100)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SerializeMessageTest))
+    return suite
@@ -0,0 +1,76 @@
+import unittest
+
+from rss2maildir.Scheduler import Scheduler, next_poll
+
+hour = 3600
+day = 24 * hour
+
+class NextPollTest(unittest.TestCase):
+    def test_never_polled(self):
+        self.assertEqual(next_poll({}, hour, 0, day), 0)
+
+    def test_configured_interval(self):
+        self.assertEqual(next_poll({'polled': 1000}, hour, 0, day), 1000 + hour)
+
+    def test_interval_is_clamped(self):
+        self.assertEqual(next_poll({'polled': 1000}, 10, 60, day), 1000 + 60)
+        self.assertEqual(next_poll({'polled': 1000}, 2 * day, 60, day), 1000 + day)
+
+    def test_retry(self):
+        metadata = {'polled': 1000, 'retry': 1900, 'history': [0, 100, 200]}
+        self.assertEqual(next_poll(metadata, hour, 0, day), 1900)
+
+    def test_learned_interval(self):
+        # an item every 2 hours, the feed is polled twice as often
+        metadata = {'polled': 4 * hour, 'history': [0, 2 * hour, 4 * hour]}
+        self.assertEqual(next_poll(metadata, day, 0, day), 5 * hour)
+
+    def test_quiet_feed(self):
+        # nothing new for 10 hours, the gaps between the items do not count
+        metadata = {'polled': 14 * hour, 'history': [0, 2 * hour, 4 * hour]}
+        self.assertEqual(next_poll(metadata, day, 0, day), 19 * hour)
+
+    def test_single_item_uses_configured_interval(self):
+        metadata = {'polled': 1000, 'history': [500]}
+        self.assertEqual(next_poll(metadata, hour, 0, day), 1000 + hour)
+
+    def test_hint(self):
+        self.assertEqual(next_poll({'polled': 1000, 'hint': 2 * hour}, hour, 0, day),
+                         1000 + 2 * hour)
+        # hints never shorten the interval
+        self.assertEqual(next_poll({'polled': 1000, 'hint': 60}, hour, 0, day),
+                         1000 + hour)
+
+    def test_hint_is_clamped(self):
+        self.assertEqual(next_poll({'polled': 1000, 'hint': 30 * day}, hour, 0, day),
+                         1000 + day)
+
+class SchedulerTest(unittest.TestCase):
+    def test_pop_due_in_order(self):
+        scheduler = Scheduler()
+        scheduler.schedule('b', 20)
+        scheduler.schedule('a', 10)
+        scheduler.schedule('c', 30)
+        self.assertEqual(scheduler.next_due(), 10)
+        self.assertEqual(scheduler.pop_due(25), ['a', 'b'])
+        self.assertEqual(scheduler.next_due(), 30)
+
+    def test_reschedule(self):
+        scheduler = Scheduler()
+        scheduler.schedule('a', 10)
+        scheduler.schedule('a', 50)
+        self.assertEqual(scheduler.pop_due(25), [])
+        self.assertEqual(scheduler.pop_due(50), ['a'])
+        self.assertEqual(scheduler.next_due(), None)
+
+    def test_update(self):
+        scheduler = Scheduler()
+        scheduler.schedule('a', 10)
+        scheduler.update(['b'], lambda url: 20)
+        self.assertEqual(scheduler.pop_due(100), ['b'])
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(NextPollTest))
+    suite.addTest(unittest.makeSuite(SchedulerTest))
+    return suite
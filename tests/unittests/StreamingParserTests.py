@@ -0,0 +1,134 @@
+import unittest
+import StringIO
+
+import feedparser
+
+from rss2maildir.StreamingParser import StreamingParser, ParseError
+
+rss2 = u'''<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xml:base="http://example.org/blog/"
+     xmlns:content="http://purl.org/rss/1.0/modules/content/">
+<channel>
+<title>A feed</title>
+<link>http://example.org/blog/</link>
+<ttl>60</ttl>
+<item>
+<title>Caf\u00e9</title>
+<link>first.html</link>
+<guid isPermaLink="false">urn:1</guid>
+<author>someone@example.org (Someone)</author>
+<category>python</category>
+<category>web</category>
+<description>A &lt;b&gt;short&lt;/b&gt; description</description>
+<content:encoded><![CDATA[<p>The <a href="full.html">full</a> text</p>]]></content:encoded>
+<pubDate>Mon, 06 Sep 2010 16:45:00 +0000</pubDate>
+</item>
+<item xml:base="second/">
+<title>Second</title>
+<guid>index.html</guid>
+<description>Plain text</description>
+</item>
+</channel>
+</rss>'''.encode('utf-8')
+
+rss1 = '''<?xml version="1.0" encoding="utf-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+         xmlns="http://purl.org/rss/1.0/"
+         xmlns:dc="http://purl.org/dc/elements/1.1/"
+         xml:base="http://example.org/blog/">
+<channel rdf:about="http://example.org/blog/">
+<title>A feed</title>
+</channel>
+<item rdf:about="http://example.org/blog/first">
+<title>First</title>
+<link>first.html</link>
+<dc:creator>Someone</dc:creator>
+<dc:subject>python</dc:subject>
+<dc:date>2010-09-06T16:45:00Z</dc:date>
+<description>A description</description>
+</item>
+<item rdf:about="urn:2">
+<title>Second</title>
+<link>http://example.org/blog/second</link>
+</item>
+</rdf:RDF>'''
+
+atom = '''<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xml:base="http://example.org/blog/">
+<title>A feed</title>
+<id>urn:feed</id>
+<entry>
+<title>First</title>
+<id>urn:1</id>
+<link href="first.html"/>
+<author><name>Someone</name><email>someone@example.org</email></author>
+<category term="python"/>
+<updated>2010-09-06T16:45:00Z</updated>
+<summary>A summary</summary>
+<content type="xhtml"><div xmlns="http://www.w3.org/1999/xhtml">The <a href="full.html">full</a> text</div></content>
+</entry>
+<entry xml:base="second/">
+<title type="html">&lt;i&gt;Second&lt;/i&gt;</title>
+<id>entry</id>
+<link rel="alternate" href="index.html"/>
+<published>2010-09-07T10:00:00+02:00</published>
+<content type="html">&lt;p&gt;Some &lt;img src="image.png"&gt;&lt;/p&gt;</content>
+</entry>
+<entry>
+<title>Third</title>
+<id>tag:example.org,2010:3</id>
+</entry>
+</feed>'''
+
+fields = ('title', 'link', 'guid', 'author', 'description')
+
+def normalize(feed_item):
+    normalized = dict((field, feed_item.get(field)) for field in fields)
+    if feed_item.get('content'):
+        normalized['content'] = feed_item['content'][0]['value']
+    if feed_item.get('updated_parsed'):
+        normalized['updated_parsed'] = tuple(feed_item['updated_parsed'])[:6]
+    normalized['tags'] = [tag['term'] for tag in feed_item.get('tags', [])]
+    return normalized
+
+class StreamingParserTest(unittest.TestCase):
+    def compare(self, document, count):
+        expected = feedparser.parse(document)['items']
+        parsed = list(StreamingParser(StringIO.StringIO(document)).items())
+        self.assertEqual(len(parsed), count)
+        self.assertEqual([normalize(feed_item) for feed_item in parsed],
+                         [normalize(feed_item) for feed_item in expected])
+
+    def test_rss2(self):
+        self.compare(rss2, 2)
+
+    def test_rss1(self):
+        self.compare(rss1, 2)
+
+    def test_atom(self):
+        self.compare(atom, 3)
+
+    def test_ids_are_resolved(self):
+        parsed = list(StreamingParser(StringIO.StringIO(atom)).items())
+        self.assertEqual([feed_item['guid'] for feed_item in parsed],
+                         ['http://example.org/blog/urn:1',
+                          'http://example.org/blog/second/entry',
+                          'tag:example.org,2010:3'])
+
+    def test_ttl(self):
+        parser = StreamingParser(StringIO.StringIO(rss2))
+        list(parser.items())
+        self.assertEqual(parser.feed['ttl'], '60')
+
+    def test_not_well_formed(self):
+        parser = StreamingParser(StringIO.StringIO(rss2.replace('</item>', '', 1)))
+        self.assertRaises(ParseError, list, parser.items())
+
+    def test_not_a_feed(self):
+        parser = StreamingParser(StringIO.StringIO('<html><body/></html>'))
+        self.assertRaises(ParseError, list, parser.items())
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(StreamingParserTest))
+    return suite